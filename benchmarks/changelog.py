@@ -0,0 +1,70 @@
+"""Compare tip(), parents() and isancestor() answered by hg with the same
+calls answered from the changelog read in process (hgclient.setchangelog()),
+on a repository given on the command line. hg has to be on the PATH. The
+commands the fast paths still ran are counted: none is expected once the
+tags were read, unless the changelog format or the encoding rules the
+reader out.
+
+    python benchmarks/changelog.py repository [iterations]
+"""
+import os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hglib
+from hglib import revlog
+
+def _client(path, fast):
+    c = hglib.open(path)
+    if fast:
+        c.setchangelog(revlog.changelog(c._reporoot()))
+    commands = []
+    rawcommand = c.rawcommand
+
+    def counting(args, *a, **kw):
+        commands.append(args[0])
+        return rawcommand(args, *a, **kw)
+    c.rawcommand = counting
+    return c, commands
+
+def bench(c, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(c, i)
+    return time.perf_counter() - start
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    path = sys.argv[1]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    c, commands = _client(path, False)
+    tip = int(c.tip().rev)
+    rand = random.Random(0)
+    pairs = [tuple(sorted(rand.randint(0, tip) for j in range(2)))
+             for i in range(iterations)]
+    c.close()
+    benches = [
+        ('tip', lambda c, i: c.tip()),
+        ('parents', lambda c, i: c.parents()),
+        ('isancestor', lambda c, i: c.isancestor(*pairs[i])),
+    ]
+    print('%s: %d revisions, %d calls each' % (path, tip + 1, iterations))
+    results = {}
+    for name, fast in (('hg', False), ('in process', True)):
+        c, commands = _client(path, fast)
+        for bench_name, func in benches:
+            # the first call reads the tags and the changelog
+            func(c, 0)
+            del commands[:]
+            elapsed = bench(c, func, iterations)
+            print('%-10s %-10s: %.4fs, %.1f us/call, %d commands' %
+                  (bench_name, name, elapsed, elapsed / iterations * 1e6,
+                   len(commands)))
+            results[bench_name, fast] = [func(c, i) for i in range(5)]
+        c.close()
+    for bench_name, func in benches:
+        assert results[bench_name, False] == results[bench_name, True], \
+            bench_name
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare the throughput of hgclient._readchannel with the reader it
+replaced, on framed command server output read from a pipe like the
+server's stdout: reading the frames alone, and collecting a command's
+output like rawcommand() does.
+
+    python benchmarks/readchannel.py [frames] [payload size]
+"""
+import io, os, struct, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hglib import client, error
+from hglib.util import b
+
+class _server(object):
+    """cat of the framed output standing for the command server"""
+    def __init__(self, path):
+        self.stdin = io.BytesIO()
+        self._proc = subprocess.Popen(['cat', path], stdout=subprocess.PIPE)
+        self.stdout = self._proc.stdout
+
+    def close(self):
+        self.stdout.close()
+        self._proc.wait()
+
+def _oldreadchannel(self):
+    # hgclient._readchannel before frames were read into reused buffers
+    data = self.server.stdout.read(client.hgclient.outputfmtsize)
+    if not data:
+        raise error.ServerError()
+    channel, length = struct.unpack(client.hgclient.outputfmt, data)
+    if channel in b('IL'):
+        return channel, length
+    else:
+        return channel, self.server.stdout.read(length)
+
+def _oldrawcommand(c, args):
+    # what rawcommand() did with the output before it collected chunks
+    out = io.BytesIO()
+    c.runcommand(args, {}, {b('o'): out.write})
+    return out.getvalue()
+
+def frames(count, size):
+    payload = b('x') * size
+    return ((struct.pack('>cI', b('o'), size) + payload) * count +
+            struct.pack('>cIi', b('r'), 4, 0))
+
+def _client(path):
+    c = client.hgclient(None, None, None, connect=False)
+    c.server = _server(path)
+    return c
+
+def readframes(old, path, count, size):
+    c = _client(path)
+    readchannel = _oldreadchannel if old else client.hgclient._readchannel
+    start = time.perf_counter()
+    for i in range(count):
+        readchannel(c)
+    elapsed = time.perf_counter() - start
+    c.server.close()
+    return elapsed
+
+def collect(old, path, count, size):
+    c = _client(path)
+    if old:
+        c._readchannel = lambda: _oldreadchannel(c)
+    start = time.perf_counter()
+    out = _oldrawcommand(c, [b('log')]) if old else c.rawcommand([b('log')])
+    elapsed = time.perf_counter() - start
+    c.server.close()
+    assert len(out) == count * size
+    return elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(frames(count, size))
+        mb = count * size / 1e6
+        print('%d frames of %d bytes' % (count, size))
+        for bench in (readframes, collect):
+            for name, old in (('old', True), ('new', False)):
+                best = min(bench(old, path, count, size) for i in range(5))
+                print('%-10s %s: %.3fs, %.0f MB/s' %
+                      (bench.__name__, name, best, mb / best))
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compare the memory taken by the history of a generated log kept as the
+list of revision tuples hgclient.log() returns, as a revstore.revisions and
+as a revstore.lazyrevisions: the peak while building it from the output of
+the changeset template and what stays allocated once it's built, measured
+with tracemalloc. The times include its overhead, which is the largest for
+the code allocating the most.
+
+    python benchmarks/revstore.py [revisions]
+"""
+import gc, os, random, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hglib import client, revstore, util
+from hglib.util import b, strtobytes
+
+def output(count):
+    """the output of the changeset template for count revisions, a few
+    branches and authors and descriptions of various lengths"""
+    rand = random.Random(0)
+    branches = [b('default'), b('stable')] + [b('feature-%d' % i)
+                                               for i in range(8)]
+    authors = [b('User %d <user%d@example.com>' % (i, i)) for i in range(40)]
+    records = []
+    for rev in range(count - 1, -1, -1):
+        node = b('%040x' % rand.getrandbits(160))
+        tags = b('tip') if rev == count - 1 else (
+            b('v%d' % rev) if rev % 500 == 0 else b(''))
+        desc = b(' ').join(b('word%d' % rand.randint(0, 999))
+                           for i in range(rand.randint(3, 60)))
+        date = b('%d.0-7200' % (1500000000 + rev * 600))
+        records.append(b('\0').join([
+            strtobytes(rev), node, tags, rand.choice(branches),
+            rand.choice(authors), desc, date]) + b('\0'))
+    return b('').join(records)
+
+def chunks(out, size=4096):
+    # the output as rawcommand() receives it
+    for i in range(0, len(out), size):
+        yield out[i:i + size]
+
+def tuples(out):
+    return client.hgclient._parserevs(out.split(b('\0'))[:-1])
+
+def columns(out):
+    return revstore.revisions(util.splitchunks(chunks(out), b('\0')))
+
+def lazy(out):
+    return revstore.lazyrevisions(out)
+
+def measure(build, out):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    revs = build(out)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if build is lazy:
+        # it keeps the output, allocated before tracing started
+        current += len(out)
+        peak += len(out)
+    assert len(revs) == len(tuples(out))
+    return elapsed, current, peak
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    out = output(count)
+    print('%d revisions, %.1f MB of log output' % (count, len(out) / 1e6))
+    for build in (tuples, columns, lazy):
+        elapsed, current, peak = measure(build, out)
+        print('%-8s %.2fs, %6.1f MB kept, %6.1f MB peak' %
+              (build.__name__, elapsed, current / 1e6, peak / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,46 @@
-import subprocess
-from hglib import client, util, error
+import subprocess, tempfile
+from hglib import client, util, error, pool
 
 HGPATH = 'hg'
 
-def open(path=None, encoding=None, configs=None):
+def open(path=None, encoding=None, configs=None, socketpath=None):
     '''starts a cmdserver for the given path (or for a repository found
     in the cwd). HGENCODING is set to the given encoding. configs is a
     list of key, value, similar to those passed to hg --config.
+
+    When socketpath is given, connects to the forking cmdserver listening
+    on that unix socket instead, starting it first if needed. The server
+    keeps running after the client is closed so later clients skip the
+    startup, until util.stopserver() stops it. See util.socketpath() for a
+    default socketpath.
+    '''
+    return client.hgclient(path, encoding, configs, socketpath=socketpath)
+
+def openpool(path=None, size=4, encoding=None, configs=None,
+             socketpath=None, cachesize=0, watch=0, nodes=False,
+             changelog=False, mirror=False):
+    '''starts a pool of up to size cmdservers for the given path (or for a
+    repository found in the cwd), the arguments are the same as for open().
+    Read-only commands run in parallel on the pool's clients, the others
+    are exclusive. When cachesize is given, that many results of read-only
+    commands are cached for all the clients (see hgclient.setcache()).
+    When watch is given, status() is limited to the paths touched since
+    its last call, watch being the seconds between full statuses (see
+    watcher.dirtywatcher). It's ignored where inotify isn't available.
+    nodes, changelog and mirror have the clients share the in-process
+    readers of the repository described in pool.clientpool.
+    '''
+    return pool.clientpool(path, size, encoding, configs, socketpath,
+                           cachesize=cachesize, watch=watch, nodes=nodes,
+                           changelog=changelog, mirror=mirror)
+
+def openshared(encoding=None, configs=None):
+    '''starts a cmdserver outside of any repository. Use its forrepo()
+    to get clients for given repositories that all run their commands on
+    this single server. The other arguments are the same as for open().
     '''
-    return client.hgclient(path, encoding, configs)
+    return client.hgclient(None, encoding, configs,
+                           cwd=tempfile.gettempdir())
 
 def init(dest=None, ssh=None, remotecmd=None, insecure=False,
          encoding=None, configs=None):
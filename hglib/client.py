@@ -1,8 +1,9 @@
-import struct, re, datetime
+import os, sys, struct, re, binascii, datetime, copy, threading, errno
 import hglib
-from hglib import error, util, templates, merge, context
+from hglib import error, util, templates, merge, context, repostate, revstore
+from hglib import revlog
 
-from hglib.util import b, cmdbuilder, BytesIO, strtobytes
+from hglib.util import b, cmdbuilder, strtobytes
 
 class revision(tuple):
     def __new__(cls, rev, node, tags, branch, author, desc, date):
@@ -36,15 +37,63 @@ class revision(tuple):
     def date(self):
         return self[6]
 
+def _copyresult(result):
+    """copy the containers of a cached result so callers can't change it"""
+    if isinstance(result, list):
+        return list(result)
+    if isinstance(result, dict):
+        return dict(result)
+    if type(result) is tuple:
+        return tuple(_copyresult(r) for r in result)
+    return result
+
+def cached(func):
+    """Decorator for the hgclient methods whose result only depends on the
+    arguments and on the repository state tracked by repostate.fingerprint()
+    so they can be served from the client's cache, see hgclient.setcache()
+    """
+    name = func.__name__
+    def wrapper(self, *args, **kwargs):
+        if self._cache is None:
+            return func(self, *args, **kwargs)
+        # results for an outdated state are never hit again and get evicted
+        key = (name, repr(args), repr(sorted(kwargs.items())), self.hidden,
+               repostate.fingerprint(self._reporoot()))
+        result = self._cache.get(key, self._cache)
+        if result is self._cache:
+            result = func(self, *args, **kwargs)
+            self._cache.put(key, result)
+        return _copyresult(result)
+    wrapper.__name__ = name
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 class hgclient(object):
     inputfmt = '>I'
+    inputstruct = struct.Struct(inputfmt)
     outputfmt = '>cI'
-    outputfmtsize = struct.calcsize(outputfmt)
+    outputstruct = struct.Struct(outputfmt)
+    outputfmtsize = outputstruct.size
     retfmt = '>i'
-
-    def __init__(self, path, encoding, configs, connect=True):
-        self._args = [hglib.HGPATH, 'serve', '--cmdserver', 'pipe',
-                '--config', 'ui.interactive=True']
+    retstruct = struct.Struct(retfmt)
+    # the channels whose frames have no payload but a length
+    inputchannels = b('IL')
+    # bytes of stdout kept for prompts and errors when it isn't kept whole
+    outputtail = 4096
+
+    def __init__(self, path, encoding, configs, connect=True, socketpath=None,
+                 cwd=None):
+        if socketpath:
+            # a forking server that outlives this client, every connection
+            # to it is served by a fork of the warmed up server
+            self._args = [hglib.HGPATH, 'serve', '--cmdserver', 'unix',
+                    '--address', socketpath, '--daemon',
+                    '--pid-file', socketpath + '.pid',
+                    '--config', 'ui.interactive=True']
+        else:
+            self._args = [hglib.HGPATH, 'serve', '--cmdserver', 'pipe',
+                    '--config', 'ui.interactive=True']
+        self._socketpath = socketpath
         if path:
             self._args += ['-R', path]
         if configs:
@@ -53,12 +102,37 @@ class hgclient(object):
         self._env = {'HGPLAIN': '1'}
         if encoding:
             self._env['HGENCODING'] = encoding
+        self._cwd = cwd
+        self._root = path
+        self._cache = None
+        self._watcher = None
+        self._ctxcache = context.ctxcache()
+        # (storefingerprint, {rev: (phase, hidden)}) filled by phases()
+        self._phases = (None, {})
+        # (key, {node: tags}) filled by _nodetags()
+        self._tags = (None, {})
+        self._nodeindex = None
+        self._mirror = None
+        self._changelog = None
 
         self.server = None
+        self._pid = None
+        # global options passed to each command, see forrepo()
+        self._repoargs = []
+        # serializes the commands of clients sharing the server
+        self._lock = None
+        self._shared = False
         self._version = None
+        # preallocated buffers reused by _readchannel
+        self._header = bytearray(hgclient.outputfmtsize)
+        self._headerview = memoryview(self._header)
+        self._buffer = bytearray(4096)
+        self._bufferview = memoryview(self._buffer)
         # include the hidden changesets if True
         self.hidden = None
 
+        self._streaming = False
+
         self._cbout = None
         self._cberr = None
         self._cbprompt = None
@@ -69,10 +143,244 @@ class hgclient(object):
 
         self._protocoltracefn = None
 
+    @property
+    def pid(self):
+        """the process id of the command server, None if unknown"""
+        return self._pid
+
+    def setcache(self, cache):
+        """
+        Serve the results of read-only methods (branches, tags, bookmarks,
+        heads, log, paths and config) from cache, a util.lrucache that can be
+        shared by the clients of one repository, as long as the repository's
+        state fingerprint (see repostate.fingerprint()) doesn't change.
+        Call with None to stop caching.
+        """
+        self._cache = cache
+
+    def setctxcache(self, ctxcache):
+        """
+        Intern the changectx objects returned by client[changeid] and by
+        the contexts' parents, children, ancestors... in ctxcache, a
+        context.ctxcache. Each client has its own by default, call with
+        None to stop interning. Don't share one between clients: the
+        contexts run hg with the client that made them.
+        """
+        self._ctxcache = ctxcache
+
+    def _changectx(self, changeid):
+        if self._ctxcache is None:
+            return context.changectx(self, changeid)
+        return self._ctxcache.lookup(self, changeid)
+
+    def setnodeindex(self, index):
+        """
+        Answer `node in client` for full hex nodes from index, a
+        nodeindex.nodeindex that can be shared by the clients of one
+        repository, or None to always ask hg. There's none by default:
+        filling one runs a log of the whole changelog, see clientpool's
+        nodes.
+        """
+        self._nodeindex = index
+
+    def nodeindex(self):
+        """
+        Return the client's nodeindex.nodeindex brought up to date, to check
+        for nodes and resolve short hashes without running a command.
+        """
+        if self._nodeindex is None:
+            raise ValueError('no node index, see setnodeindex()')
+        self._nodeindex.update(self)
+        return self._nodeindex
+
+    def setmirror(self, mirror):
+        """
+        Look changesets up by revision number (client[rev], the contexts'
+        parents...) and read the whole history (log() with no revision
+        range) in mirror, a mirror.changelogmirror of the repository that
+        can be shared by its clients, instead of running log. Call with
+        None to stop.
+        """
+        self._mirror = mirror
+
+    def mirror(self):
+        """
+        Return the client's mirror.changelogmirror brought up to date, to
+        read the history without running a command.
+        """
+        if self._mirror is None:
+            raise ValueError('no changelog mirror, see setmirror()')
+        self._mirror.update(self)
+        return self._mirror
+
+    def _mirrored(self, rev):
+        """True if rev can be read from the mirror"""
+        if self._mirror is None or rev < 0:
+            return False
+        if not self.hidden and repostate.hasobsmarkers(self._reporoot()):
+            # the mirror doesn't know which changesets are hidden
+            return False
+        return rev < len(self.mirror())
+
+    def _mirrorrevision(self, rev):
+        """the revision tuple of rev read from the mirror, None if it can't
+        be"""
+        if not self._mirrored(rev):
+            return None
+        # the tags are the only field that isn't mirrored
+        try:
+            tip = len(self._mirror) - 1
+            return self._tagged(self._mirror[rev],
+                                self._nodetags(tip, self._mirror.node(tip)))
+        except IndexError:
+            # stripped meanwhile
+            return None
+
+    def _mirrorlog(self, limit=None):
+        """the history log() returns with no revision range and no filter,
+        read from the mirror, None if it can't be"""
+        if not self._mirrored(0) or (limit is not None and int(limit) < 1):
+            return None
+        try:
+            tip = len(self._mirror) - 1
+            tags = self._nodetags(tip, self._mirror.node(tip))
+            stop = -1 if limit is None else max(tip - int(limit), -1)
+            return [self._tagged(self._mirror[rev], tags)
+                    for rev in range(tip, stop, -1)]
+        except IndexError:
+            # stripped meanwhile
+            return None
+
+    def _nodetags(self, tiprev, tipnode):
+        """
+        {hex node: tag names} of the changesets with tags, tip included,
+        when the changelog ends at tiprev and tipnode (hex). Read from hg's
+        tags cache and the local tags when the cache is up to date, with a
+        log otherwise, and kept until the store changes.
+        """
+        root = self._reporoot()
+        key = (repostate.storefingerprint(root), tiprev, tipnode)
+        if self._tags[0] == key:
+            return self._tags[1]
+        nodetags = None
+        tags = repostate.cachedtags(root, tiprev, binascii.unhexlify(tipnode),
+                                    self.hidden)
+        if tags is not None:
+            encoding = self.encoding.decode('ascii')
+            try:
+                tags = dict((name.decode('utf-8').encode(encoding), node)
+                            for name, node in tags.items())
+            except UnicodeError:
+                tags = None
+        if tags is not None:
+            tags.update(repostate.localtags(root))
+            tags[b('tip')] = binascii.unhexlify(tipnode)
+            nodetags = {}
+            for name, node in tags.items():
+                if node != repostate.nullid:
+                    node = binascii.hexlify(node)
+                    nodetags.setdefault(node, []).append(name)
+            for names in nodetags.values():
+                names.sort()
+        else:
+            args = cmdbuilder(b('log'), template=b('{node}\\0{tags}\\0'),
+                              r=b('tag() or tip'), hidden=self.hidden)
+            out = self.rawcommand(args).split(b('\0'))[:-1]
+            nodetags = dict((out[i], out[i + 1].split())
+                            for i in range(0, len(out), 2))
+        self._tags = (key, nodetags)
+        return nodetags
+
+    def _tagged(self, r, nodetags):
+        """r, a revision read without running log, with its tags from
+        nodetags (see _nodetags())"""
+        tags = b(' ').join(nodetags.get(r.node, []))
+        return revision(r.rev, r.node, tags, r.branch, r.author, r.desc,
+                        r.date)
+
+    def setchangelog(self, changelog):
+        """
+        Answer tip(), parents() and isancestor() from changelog, a
+        revlog.changelog of the repository read in process, when its format
+        allows it. Call with None to always ask hg.
+        """
+        self._changelog = changelog
+
+    def changelog(self):
+        """
+        Return the client's revlog.changelog brought up to date. Raise
+        error.FormatError if the changelog can't be read without hg.
+        """
+        if self._changelog is None:
+            raise ValueError('no changelog reader, see setchangelog()')
+        self._changelog.refresh()
+        return self._changelog
+
+    def _changelogreader(self, text=False, visible=True):
+        """
+        The up to date changelog reader, None when there's none or it can't
+        be used. text - the revisions' text will be read, which is stored
+        in UTF-8. visible - hidden changesets have to be left out, which
+        the changelog doesn't know about.
+        """
+        if self._changelog is None:
+            return None
+        if text and self.encoding.lower() not in (b('utf-8'), b('utf8')):
+            return None
+        if (visible and not self.hidden and
+            repostate.hasobsmarkers(self._reporoot())):
+            return None
+        try:
+            return self.changelog()
+        except error.FormatError:
+            return None
+
+    def changectxs(self, revrange, hidden=None):
+        """
+        Return the context.changectx of each revision in revrange with
+        their parents, phase, bookmarks, added, modified and removed files
+        and hidden and obsolete flags read by the same log command (see
+        templates.changesetext), so these don't run a command each.
+
+        hidden - include the hidden changesets, defaults to self.hidden
+        """
+        if hidden is None:
+            hidden = self.hidden
+        args = cmdbuilder(b('log'), template=templates.changesetext,
+                          r=revrange, hidden=hidden)
+        out = self.rawcommand(args).split(b('\0'))[:-1]
+
+        ctxs = []
+        for fields in util.grouper(16, out):
+            ctx = context.changectx(self, self._parserev(fields[:7]))
+            if self._ctxcache is not None:
+                ctx = self._ctxcache.intern(self, ctx)
+            ctx._fill(fields[7:])
+            ctxs.append(ctx)
+        return ctxs
+
+    def setwatcher(self, watcher):
+        """
+        Let watcher, a watcher.dirtywatcher of the repository's working
+        directory, limit status() to the paths touched since the last call.
+        Only status() calls without arguments use it. Call with None to stop.
+        """
+        self._watcher = watcher
+
+    def _reporoot(self):
+        if self._root is None:
+            self._root = self.root()
+        if isinstance(self._root, bytes):
+            self._root = self._root.decode(sys.getfilesystemencoding())
+        return self._root
+
     def setcbout(self, cbout):
         """
         cbout is a function that will be called with the stdout data of
         the command as it runs. Call with None to stop getting call backs.
+
+        The data is a memoryview that is only valid during the call, copy
+        it if it has to be kept.
         """
         self._cbout = cbout
 
@@ -80,6 +388,9 @@ class hgclient(object):
         """
         cberr is a function that will be called with the stderr data of
         the command as it runs.Call with None to stop getting call backs.
+
+        The data is a memoryview that is only valid during the call, copy
+        it if it has to be kept.
         """
         self._cberr = cberr
 
@@ -106,6 +417,7 @@ class hgclient(object):
         direction is 'r' for read from server and 'w' for write to server
         channel is always None when direction is 'w'
         and the channel-identified when the direction is 'r'
+        data read from the server is a memoryview only valid during the call
         """
         self._protocoltracefn = tracefn
 
@@ -122,7 +434,7 @@ class hgclient(object):
         ch, msg = self._readchannel()
         assert ch == b('o')
 
-        msg = msg.split(b('\n'))
+        msg = bytes(msg).split(b('\n'))
 
         self.capabilities = msg[0][len(b('capabilities: ')):]
         if not self.capabilities:
@@ -140,43 +452,128 @@ class hgclient(object):
             raise error.ResponseError("bad hello message: expected 'encoding: '"
                                       ", got %r" % msg[1])
 
+        # servers forked for a connection announce their pid
+        for line in msg[2:]:
+            if line.startswith(b('pid: ')):
+                self._pid = int(line[len(b('pid: ')):])
+
+    def _readexactly(self, view, pos=0):
+        """fill the writable memoryview from the server's stdout, its first
+        pos bytes being read already"""
+        readinto = self.server.stdout.readinto
+        size = len(view)
+        while pos < size:
+            n = readinto(view[pos:])
+            if not n:
+                raise error.ServerError()
+            pos += n
+
     def _readchannel(self):
-        data = self.server.stdout.read(hgclient.outputfmtsize)
-        if not data:
-            raise error.ServerError()
-        channel, length = struct.unpack(hgclient.outputfmt, data)
-        if channel in b('IL'):
+        """read one frame from the server
+
+        The payload is returned as a memoryview over a buffer that is
+        reused by the next call.
+        """
+        readinto = self.server.stdout.readinto
+        # a buffered stdout fills the views in one call but for the
+        # largest frames, _readexactly() reads the rest
+        n = readinto(self._headerview)
+        if n != hgclient.outputfmtsize:
+            self._readexactly(self._headerview, n or 0)
+        channel, length = hgclient.outputstruct.unpack(self._header)
+        if channel in hgclient.inputchannels:
             return channel, length
-        else:
-            return channel, self.server.stdout.read(length)
+        if length > len(self._buffer):
+            # a new buffer, views into the old one may still be alive
+            self._buffer = bytearray(max(length, 2 * len(self._buffer)))
+            self._bufferview = memoryview(self._buffer)
+        data = self._bufferview[:length]
+        n = readinto(data)
+        if n != length:
+            self._readexactly(data, n or 0)
+        return channel, data
 
     @staticmethod
     def _parserevs(splitted):
         '''splitted is a list of fields according to our rev.style, where
         each 6 fields compose one revision.
         '''
-        revs = []
-        for rev in util.grouper(7, splitted):
-            # truncate the timezone and convert to a local datetime
-            posixtime = float(rev[6].split(b('.'), 1)[0])
-            dt = datetime.datetime.fromtimestamp(posixtime)
-            revs.append(revision(rev[0], rev[1], rev[2], rev[3],
-                                 rev[4], rev[5], dt))
-        return revs
+        return [hgclient._parserev(rev) for rev in util.grouper(7, splitted)]
 
-    def runcommand(self, args, inchannels, outchannels):
-        def writeblock(data):
-            if self._protocoltracefn is not None:
-                self._protocoltracefn('w', None, data)
-            self.server.stdin.write(struct.pack(self.inputfmt, len(data)))
-            self.server.stdin.write(data)
-            self.server.stdin.flush()
+    def _revisions(self, out, lazy=False):
+        '''parse the output of the changeset template, into lazy records
+        (see revstore.lazyrevisions) when lazy is True'''
+        if lazy:
+            return revstore.lazyrevisions(out)
+        return self._parserevs(out.split(b('\0'))[:-1])
 
+    @staticmethod
+    def _parserev(rev):
+        # truncate the timezone and convert to a local datetime
+        posixtime = float(rev[6].split(b('.'), 1)[0])
+        dt = datetime.datetime.fromtimestamp(posixtime)
+        return revision(rev[0], rev[1], rev[2], rev[3], rev[4], rev[5], dt)
+
+    def _writeblock(self, data):
+        if self._protocoltracefn is not None:
+            self._protocoltracefn('w', None, data)
+        self.server.stdin.write(hgclient.inputstruct.pack(len(data)))
+        self.server.stdin.write(data)
+        self.server.stdin.flush()
+
+    def _writecommand(self, args):
         if not self.server:
             raise ValueError("server not connected")
+        if self._streaming:
+            raise error.ServerError("the server is busy streaming the "
+                                    "output of another command")
 
         self.server.stdin.write(b('runcommand\n'))
-        writeblock(b('\0').join(args))
+        self._writeblock(b('\0').join(self._repoargs + args))
+
+    def forrepo(self, path):
+        """
+        Return a client running the commands for the repository at path on
+        this server, by passing -R path to each of them. This is meant for
+        a server started outside of any repository (see hglib.openshared())
+        to serve many repositories with a single process.
+
+        The clients share the server and run one command at a time.
+        Closing them leaves the server running.
+        """
+        if self._lock is None:
+            self._lock = threading.Lock()
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+
+        c = copy.copy(self)
+        c._root = path.decode(sys.getfilesystemencoding())
+        c._cache = None
+        c._watcher = None
+        c._ctxcache = context.ctxcache()
+        c._phases = (None, {})
+        c._tags = (None, {})
+        c._nodeindex = None
+        c._mirror = None
+        c._changelog = None
+        c._repoargs = [b('-R'), path]
+        c._shared = True
+        c._version = None
+        c._header = bytearray(hgclient.outputfmtsize)
+        c._headerview = memoryview(c._header)
+        c._buffer = bytearray(4096)
+        c._bufferview = memoryview(c._buffer)
+        c._cbout = c._cberr = c._cbprompt = c._cbret = None
+        return c
+
+    def runcommand(self, args, inchannels, outchannels):
+        if self._lock is not None:
+            with self._lock:
+                return self._runcommand(args, inchannels, outchannels)
+        return self._runcommand(args, inchannels, outchannels)
+
+    def _runcommand(self, args, inchannels, outchannels):
+        self._writecommand(args)
 
         while True:
             channel, data = self._readchannel()
@@ -185,13 +582,13 @@ class hgclient(object):
 
             # input channels
             if channel in inchannels:
-                writeblock(inchannels[channel](data))
+                self._writeblock(inchannels[channel](data))
             # output channels
             elif channel in outchannels:
                 outchannels[channel](data)
             # result channel, command finished
             elif channel == b('r'):
-                return struct.unpack(hgclient.retfmt, data)[0]
+                return hgclient.retstruct.unpack(data)[0]
             # a channel that we don't know and can't ignore
             elif channel.isupper():
                 raise error.ResponseError(
@@ -200,7 +597,8 @@ class hgclient(object):
             else:
                 pass
 
-    def rawcommand(self, args, eh=None, prompt=None, input=None):
+    def rawcommand(self, args, eh=None, prompt=None, input=None,
+                   keepoutput=True):
         """
         args is the cmdline (usually built using util.cmdbuilder)
 
@@ -213,21 +611,36 @@ class hgclient(object):
 
         input is used to reply to bulk data requests by the server
         It receives the max number of bytes to return
-        """
-        out, err = BytesIO(), BytesIO()
-        outchannels = {}
+
+        keepoutput - when False stdout is only passed to the cbout callback
+        and not kept, an empty stdout is returned, and prompt, eh and
+        CommandError only receive its last outputtail bytes
+        """
+        # the chunks are copied out of the reused frame buffer, and joined
+        # once at the end
+        out, err = [], []
+        tail = [b('')]
+        if keepoutput:
+            def keep(data):
+                out.append(bytes(data))
+        else:
+            def keep(data):
+                if len(data) >= self.outputtail:
+                    tail[0] = bytes(data[-self.outputtail:])
+                else:
+                    tail[0] = (tail[0] + bytes(data))[-self.outputtail:]
         if self._cbout is None:
-            outchannels[b('o')] = out.write
+            outchannels = {b('o'): keep}
         else:
             def out_handler(data):
-                out.write(data)
+                keep(data)
                 self._cbout(data)
-            outchannels[b('o')] = out_handler
+            outchannels = {b('o'): out_handler}
         if self._cberr is None:
-            outchannels[b('e')] = err.write
+            outchannels[b('e')] = lambda data: err.append(bytes(data))
         else:
             def err_handler(data):
-                err.write(data)
+                err.append(bytes(data))
                 self._cberr(data)
             outchannels[b('e')] = err_handler
 
@@ -236,8 +649,8 @@ class hgclient(object):
             prompt = self._cbprompt
         if prompt is not None:
             def func(size):
-                reply = prompt(size, out.getvalue())
-                return reply
+                return prompt(size,
+                              b('').join(out) if keepoutput else tail[0])
             inchannels[b('L')] = func
         if input is not None:
             inchannels[b('I')] = input
@@ -245,20 +658,116 @@ class hgclient(object):
         ret = self.runcommand(args, inchannels, outchannels)
         if self._cbret is not None:
             self._cbret(ret)
-        out, err = out.getvalue(), err.getvalue()
+        out = b('').join(out)
+        err = b('').join(err)
 
         if ret:
+            if not keepoutput:
+                out = tail[0]
             if eh is None:
                 raise error.CommandError(args, ret, out, err)
             else:
                 return eh(ret, out, err)
         return out
 
+    def iterrawcommand(self, args, eh=None, prompt=None, input=None):
+        """
+        Like rawcommand(), but yields the stdout data chunk by chunk as it
+        arrives instead of returning it all at once. The command is sent
+        when the iteration starts.
+
+        eh is called with an empty stdout after the last chunk was yielded.
+
+        prompt receives the last chunk of stdout instead of all of it.
+
+        No other command can be run until the iterator is exhausted or
+        closed. Closing it early discards the rest of the output.
+        """
+        err = []
+        last = [b('')]
+        inchannels = {}
+        if prompt is None:
+            prompt = self._cbprompt
+        if prompt is not None:
+            inchannels[b('L')] = lambda size: prompt(size, last[0])
+        if input is not None:
+            inchannels[b('I')] = input
+
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            self._writecommand(args)
+        except Exception:
+            if self._lock is not None:
+                self._lock.release()
+            raise
+        self._streaming = True
+        ret = None
+        try:
+            while True:
+                channel, data = self._readchannel()
+                if self._protocoltracefn is not None:
+                    self._protocoltracefn('r', channel, data)
+
+                if channel == b('o'):
+                    if self._cbout is not None:
+                        self._cbout(data)
+                    last[0] = data = bytes(data)
+                    yield data
+                elif channel == b('e'):
+                    if self._cberr is not None:
+                        self._cberr(data)
+                    err.append(bytes(data))
+                elif channel in inchannels:
+                    self._writeblock(inchannels[channel](data))
+                elif channel == b('r'):
+                    ret = hgclient.retstruct.unpack(data)[0]
+                    break
+                elif channel.isupper():
+                    raise error.ResponseError(
+                        "unexpected data on required channel '%s'" % channel)
+        finally:
+            try:
+                if ret is None and self.server is not None:
+                    try:
+                        self._discard()
+                    except Exception:
+                        # the server went away, report what stopped the
+                        # command instead
+                        pass
+            finally:
+                self._streaming = False
+                if self._lock is not None:
+                    self._lock.release()
+
+        if self._cbret is not None:
+            self._cbret(ret)
+        if ret:
+            err = b('').join(err)
+            if eh is None:
+                raise error.CommandError(args, ret, b(''), err)
+            else:
+                eh(ret, b(''), err)
+
+    def _discard(self):
+        """read and drop the rest of the running command's output"""
+        while True:
+            channel, data = self._readchannel()
+            if channel == b('r'):
+                return
+            elif channel in hgclient.inputchannels:
+                self._writeblock(b(''))
+
     def open(self):
         if self.server is not None:
             raise ValueError('server already open')
 
-        self.server = util.popen(self._args, self._env)
+        if self._socketpath:
+            self.server = self._connect()
+            self._pid = None
+        else:
+            self.server = util.popen(self._args, self._env, self._cwd)
+            self._pid = self.server.pid
         try:
             self._readhello()
         except error.ServerError:
@@ -267,6 +776,32 @@ class hgclient(object):
                                     % (ret, serr.strip()))
         return self
 
+    def _connect(self):
+        """connect to the unix socket server, starting it if it isn't
+        running yet"""
+        try:
+            return util.unixconnection(self._socketpath)
+        except (IOError, OSError):
+            pass
+
+        # whoever holds the lock is starting the server or stopping it
+        with util.filelock(self._socketpath + '.lock'):
+            try:
+                return util.unixconnection(self._socketpath)
+            except (IOError, OSError) as e:
+                if e.errno == errno.ECONNREFUSED:
+                    # left behind by a server that is gone
+                    os.unlink(self._socketpath)
+                elif e.errno != errno.ENOENT:
+                    raise
+            proc = util.popen(self._args, self._env)
+            _out, err = proc.communicate()
+            try:
+                return util.unixconnection(self._socketpath)
+            except (IOError, OSError):
+                raise error.ServerError('server exited with status %d: %s'
+                                        % (proc.returncode, err.strip()))
+
     def close(self):
         """Closes the command server instance and waits for it to exit,
         returns the exit code.
@@ -277,6 +812,9 @@ class hgclient(object):
         return self._close()[0]
 
     def _close(self):
+        if self._shared:
+            self.server = None
+            return 0, b('')
         _sout, serr = self.server.communicate()
         ret = self.server.returncode
         self.server = None
@@ -302,7 +840,7 @@ class hgclient(object):
                           *files)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -337,7 +875,7 @@ class hgclient(object):
                           X=exclude, *files)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -362,19 +900,35 @@ class hgclient(object):
         Yields a (info, contents) tuple for each line in a file. Info is a space
         separated string according to the given options.
         """
+        args = self._annotateargs(files, rev, nofollow, text, user, file, date,
+                                  number, changeset, line, verbose, include,
+                                  exclude)
+
+        out = self.rawcommand(args)
+
+        for line in out.splitlines():
+            yield tuple(line.split(b(': '), 1))
+
+    def iterannotate(self, *args, **kwargs):
+        """Like annotate(), but yields the lines as the output arrives.
+        See iterrawcommand() for the restrictions while iterating."""
+        args = self._annotateargs(*args, **kwargs)
+
+        for line in util.iterlines(self.iterrawcommand(args)):
+            yield tuple(line.split(b(': '), 1))
+
+    def _annotateargs(self, files, rev=None, nofollow=False, text=False,
+                      user=False, file=False, date=False, number=False,
+                      changeset=False, line=False, verbose=False, include=None,
+                      exclude=None):
         if not isinstance(files, list):
             files = [files]
 
-        args = cmdbuilder(b('annotate'), r=rev, no_follow=nofollow, a=text,
+        return cmdbuilder(b('annotate'), r=rev, no_follow=nofollow, a=text,
                           u=user, f=file, d=date, n=number, c=changeset,
                           l=line, v=verbose, I=include, X=exclude,
                           hidden=self.hidden, *files)
 
-        out = self.rawcommand(args)
-
-        for line in out.splitlines():
-            yield tuple(line.split(b(': '), 1))
-
     def archive(self, dest, rev=None, nodecode=False, prefix=None, type=None,
                 subrepos=False, include=None, exclude=None):
         """Create an unversioned archive of a repository revision.
@@ -415,7 +969,7 @@ class hgclient(object):
                           t=type, S=subrepos, I=include, X=exclude,
                           hidden=self.hidden)
 
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
     def backout(self, rev, merge=False, parent=None, tool=None, message=None,
                 logfile=None, date=None, user=None):
@@ -443,7 +997,7 @@ class hgclient(object):
                           t=tool, m=message, l=logfile, d=date, u=user,
                           hidden=self.hidden)
 
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
     def bookmark(self, name, rev=None, force=False, delete=False,
                  inactive=False, rename=None):
@@ -461,8 +1015,9 @@ class hgclient(object):
         args = cmdbuilder(b('bookmark'), name, r=rev, f=force, d=delete,
                           i=inactive, m=rename)
 
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
+    @cached
     def bookmarks(self):
         """
         Return the bookmarks as a list of (name, rev, node) and the index of the
@@ -515,6 +1070,7 @@ class hgclient(object):
             # len('reset working directory to branch ') == 34
             return out[34:]
 
+    @cached
     def branches(self, active=False, closed=False):
         """
         Returns the repository's named branches as a list of (name, rev, node).
@@ -567,7 +1123,7 @@ class hgclient(object):
                           insecure=insecure, hidden=self.hidden)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -606,12 +1162,12 @@ class hgclient(object):
         """
         args = cmdbuilder(b('clone'), source, dest, b=branch,
                           u=updaterev, r=revrange)
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
     def init(self, dest, ssh=None, remotecmd=None, insecure=False):
         args = util.cmdbuilder('init', dest, e=ssh, remotecmd=remotecmd,
                                insecure=insecure)
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
     def commit(self, message=None, logfile=None, addremove=False,
                closebranch=False, date=None, user=None, include=None,
@@ -650,6 +1206,7 @@ class hgclient(object):
         rev, node = m.groups()
         return int(rev), node
 
+    @cached
     def config(self, names=[], untrusted=False, showsource=False):
         """Return a list of (section, key, value) config settings from all
         hgrc files
@@ -722,7 +1279,7 @@ class hgclient(object):
                           I=include, X=exclude, *source)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -817,7 +1374,7 @@ class hgclient(object):
         args = cmdbuilder(b('forget'), I=include, X=exclude, *files)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -846,6 +1403,37 @@ class hgclient(object):
         exclude - exclude names matching the given patterns
 
         """
+        args, fieldcount = self._grepargs(pattern, files, all, text, follow,
+                                          ignorecase, fileswithmatches, line,
+                                          user, date, include, exclude)
+
+        def eh(ret, out, err):
+            if ret != 1:
+                raise error.CommandError(args, ret, out, err)
+            return b('')
+
+        out = self.rawcommand(args, eh=eh).split(b('\0'))
+
+        return util.grouper(fieldcount, out)
+
+    def itergrep(self, *args, **kwargs):
+        """Like grep(), but yields the matches as the output arrives.
+        See iterrawcommand() for the restrictions while iterating."""
+        args, fieldcount = self._grepargs(*args, **kwargs)
+
+        def eh(ret, out, err):
+            if ret != 1:
+                raise error.CommandError(args, ret, out, err)
+
+        out = util.splitchunks(self.iterrawcommand(args, eh=eh), b('\0'))
+
+        return util.grouper(fieldcount, out)
+
+    def _grepargs(self, pattern, files=[], all=False, text=False, follow=False,
+                  ignorecase=False, fileswithmatches=False, line=False,
+                  user=False, date=False, include=None, exclude=None):
+        """return the grep command line and the number of fields per
+        match"""
         if not isinstance(files, list):
             files = [files]
 
@@ -855,13 +1443,6 @@ class hgclient(object):
                           *[pattern] + files)
         args.append(b('-0'))
 
-        def eh(ret, out, err):
-            if ret != 1:
-                raise error.CommandError(args, ret, out, err)
-            return b('')
-
-        out = self.rawcommand(args, eh=eh).split(b('\0'))
-
         fieldcount = 3
         if user:
             fieldcount += 1
@@ -874,9 +1455,11 @@ class hgclient(object):
         if fileswithmatches:
             fieldcount -= 1
 
-        return util.grouper(fieldcount, out)
+        return args, fieldcount
 
-    def heads(self, rev=[], startrev=[], topological=False, closed=False):
+    @cached
+    def heads(self, rev=[], startrev=[], topological=False, closed=False,
+              lazy=False):
         """Return a list of current repository heads or branch heads.
 
         rev - return only branch heads on the branches associated with
@@ -887,6 +1470,8 @@ class hgclient(object):
         without children will be shown.
 
         closed - normal and closed branch heads.
+        lazy - return records that decode their fields when they're
+        accessed, see revstore.lazyrevisions
 
         """
         if not isinstance(rev, list):
@@ -901,8 +1486,7 @@ class hgclient(object):
                 raise error.CommandError(args, ret, out, err)
             return b('')
 
-        out = self.rawcommand(args, eh=eh).split(b('\0'))[:-1]
-        return self._parserevs(out)
+        return self._revisions(self.rawcommand(args, eh=eh), lazy)
 
     def identify(self, rev=None, source=None, num=False, id=False, branch=False,
                  tags=False, bookmarks=False):
@@ -972,11 +1556,11 @@ class hgclient(object):
                           date=date, user=user, similarity=similarity, _=stdin,
                           *patches)
 
-        self.rawcommand(args, prompt=prompt, input=input)
+        self.rawcommand(args, prompt=prompt, input=input, keepoutput=False)
 
     def incoming(self, revrange=None, path=None, force=False, newest=False,
                  bundle=None, bookmarks=False, branch=None, limit=None,
-                 nomerges=False, subrepos=False):
+                 nomerges=False, subrepos=False, lazy=False):
         """Return new changesets found in the specified path or the default pull
         location.
 
@@ -997,6 +1581,8 @@ class hgclient(object):
         remotecmd - specify hg command to run on the remote side
         insecure- do not verify server certificate (ignoring web.cacerts config)
         subrepos - recurse into subrepositories
+        lazy - return records that decode their fields when they're
+        accessed, see revstore.lazyrevisions
 
         """
         args = cmdbuilder(b('incoming'), path,
@@ -1020,14 +1606,14 @@ class hgclient(object):
                 bms.append(tuple(line.split()))
             return bms
         else:
-            out = out.split(b('\0'))[:-1]
-            return self._parserevs(out)
+            return self._revisions(out, lazy)
 
+    @cached
     def log(self, revrange=None, files=[], follow=False,
             followfirst=False, date=None, copies=False, keyword=None,
             removed=False, onlymerges=False, user=None, branch=None,
             prune=None, hidden=None, limit=None, nomerges=False,
-            include=None, exclude=None):
+            include=None, exclude=None, compact=False, lazy=False):
         """Return the revision history of the specified files or the entire
         project.
 
@@ -1039,7 +1625,8 @@ class hgclient(object):
 
         If revrange isn't specified, the default is "tip:0" unless
         follow is set, in which case the working directory parent is
-        used as the starting revision.
+        used as the starting revision. That history is read from the mirror
+        when there's one and nothing else is given (see setmirror()).
 
         The returned changeset is a named tuple with the following
         string fields:
@@ -1067,22 +1654,56 @@ class hgclient(object):
         nomerges - do not show merges
         include - include names matching the given patterns
         exclude - exclude names matching the given patterns
-
-        """
+        compact - return a revstore.revisions instead of a list, which takes
+         a fraction of the memory for long histories
+        lazy - return records that decode their fields when they're
+         accessed, see revstore.lazyrevisions
+
+        """
+        filters = (files, follow, followfirst, date, copies, keyword, removed,
+                   onlymerges, user, branch, prune, nomerges, include, exclude)
+        if (revrange is None and not any(filters) and not (compact or lazy)
+            and hidden in (None, self.hidden)):
+            revs = self._mirrorlog(limit)
+            if revs is not None:
+                return revs
+
+        args = self._logargs(revrange, files, follow, followfirst, date,
+                             copies, keyword, removed, onlymerges, user,
+                             branch, prune, hidden, limit, nomerges, include,
+                             exclude)
+
+        if compact:
+            # the fields are stored as they arrive, the output is never
+            # held as a whole
+            return revstore.revisions(
+                util.splitchunks(self.iterrawcommand(args), b('\0')))
+
+        return self._revisions(self.rawcommand(args), lazy)
+
+    def iterlog(self, *args, **kwargs):
+        """Like log(), but yields the revisions as the output arrives.
+        See iterrawcommand() for the restrictions while iterating."""
+        args = self._logargs(*args, **kwargs)
+
+        out = util.splitchunks(self.iterrawcommand(args), b('\0'))
+        for rev in util.grouper(7, out):
+            yield self._parserev(rev)
+
+    def _logargs(self, revrange=None, files=[], follow=False,
+                 followfirst=False, date=None, copies=False, keyword=None,
+                 removed=False, onlymerges=False, user=None, branch=None,
+                 prune=None, hidden=None, limit=None, nomerges=False,
+                 include=None, exclude=None):
         if hidden is None:
             hidden = self.hidden
-        args = cmdbuilder(b('log'), template=templates.changeset,
+        return cmdbuilder(b('log'), template=templates.changeset,
                           r=revrange, f=follow, follow_first=followfirst,
                           d=date, C=copies, k=keyword, removed=removed,
                           m=onlymerges, u=user, b=branch, P=prune,
                           l=limit, M=nomerges, I=include, X=exclude,
                           hidden=hidden, *files)
 
-        out = self.rawcommand(args)
-        out = out.split(b('\0'))[:-1]
-
-        return self._parserevs(out)
-
     def manifest(self, rev=None, all=False):
         """Yields (nodeid, permission, executable, symlink, file path) tuples
         for version controlled files for the given revision. If no
@@ -1093,8 +1714,7 @@ class hgclient(object):
         (just the name). This includes deleted and renamed files.
 
         """
-        args = cmdbuilder(b('manifest'), r=rev, all=all, debug=True,
-                          hidden=self.hidden)
+        args = self._manifestargs(rev, all)
 
         out = self.rawcommand(args)
 
@@ -1103,11 +1723,32 @@ class hgclient(object):
                 yield line
         else:
             for line in out.splitlines():
-                node = line[0:40]
-                perm = line[41:44]
-                symlink = line[45:46] == b('@')
-                executable = line[45:46] == b('*')
-                yield node, perm, executable, symlink, line[47:]
+                yield self._parsemanifestline(line)
+
+    def itermanifest(self, rev=None, all=False):
+        """Like manifest(), but yields the files as the output arrives.
+        See iterrawcommand() for the restrictions while iterating."""
+        args = self._manifestargs(rev, all)
+
+        lines = util.iterlines(self.iterrawcommand(args))
+        if all:
+            for line in lines:
+                yield line
+        else:
+            for line in lines:
+                yield self._parsemanifestline(line)
+
+    def _manifestargs(self, rev=None, all=False):
+        return cmdbuilder(b('manifest'), r=rev, all=all, debug=True,
+                          hidden=self.hidden)
+
+    @staticmethod
+    def _parsemanifestline(line):
+        node = line[0:40]
+        perm = line[41:44]
+        symlink = line[45:46] == b('@')
+        executable = line[45:46] == b('*')
+        return node, perm, executable, symlink, line[47:]
 
     def merge(self, rev=None, force=False, tool=None, cb=merge.handlers.abort):
         """Merge working directory with rev. If no revision is specified, the
@@ -1145,7 +1786,7 @@ class hgclient(object):
         else:
             prompt = lambda size, output: cb(output) + b('\n')
 
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
     def move(self, source, dest, after=False, force=False, dryrun=False,
              include=None, exclude=None):
@@ -1172,13 +1813,13 @@ class hgclient(object):
                           I=include, X=exclude, *source)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
     def outgoing(self, revrange=None, path=None, force=False, newest=False,
                  bookmarks=False, branch=None, limit=None, nomerges=False,
-                 subrepos=False):
+                 subrepos=False, lazy=False):
         """Return changesets not found in the specified path or the default push
         location.
 
@@ -1194,6 +1835,8 @@ class hgclient(object):
         the remote side insecure - do not verify server certificate
         (ignoring web.cacerts config) subrepos - recurse into
         subrepositories
+        lazy - return records that decode their fields when they're
+        accessed, see revstore.lazyrevisions
 
         """
         args = cmdbuilder(b('outgoing'),
@@ -1217,8 +1860,7 @@ class hgclient(object):
                 bms.append(tuple(line.split()))
             return bms
         else:
-            out = out.split(b('\0'))[:-1]
-            return self._parserevs(out)
+            return self._revisions(out, lazy)
 
     def parents(self, rev=None, file=None):
         """Return the working directory's parent revisions. If rev is given,
@@ -1228,6 +1870,20 @@ class hgclient(object):
         is returned.
 
         """
+        if rev is None and file is None:
+            # the working directory parents are never hidden
+            cl = self._changelogreader(text=True, visible=False)
+            parents = repostate.dirstateparents(self._reporoot())
+            if cl is not None and parents is not None:
+                revs = [cl.rev(node) for node in parents
+                        if node != repostate.nullid]
+                if None not in revs:
+                    try:
+                        tags = self._nodetags(cl.tip(), cl.node(cl.tip()))
+                        return [self._tagged(cl[r], tags) for r in revs] or None
+                    except error.FormatError:
+                        pass
+
         args = cmdbuilder(b('parents'), file, template=templates.changeset,
                           r=rev, hidden=self.hidden)
 
@@ -1239,6 +1895,7 @@ class hgclient(object):
 
         return self._parserevs(out)
 
+    @cached
     def paths(self, name=None):
         """
         Return the definition of given symbolic path name. If no name is given,
@@ -1291,7 +1948,7 @@ class hgclient(object):
                           t=tool, rebase=rebase)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -1327,7 +1984,7 @@ class hgclient(object):
                           insecure=insecure)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -1336,7 +1993,7 @@ class hgclient(object):
             raise ValueError("cannot specify both continue and abort")
         args = cmdbuilder(b('rebase'), c=continue_rebase, a=abort_rebase)
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
         return bool(eh)
 
     def remove(self, files, after=False, force=False, include=None,
@@ -1360,7 +2017,7 @@ class hgclient(object):
                           *files)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -1432,7 +2089,7 @@ class hgclient(object):
                           hidden=self.hidden, *files)
 
         eh = util.reterrorhandler(args)
-        self.rawcommand(args, eh=eh)
+        self.rawcommand(args, eh=eh, keepoutput=False)
 
         return bool(eh)
 
@@ -1445,7 +2102,7 @@ class hgclient(object):
     def status(self, rev=None, change=None, all=False, modified=False,
                added=False, removed=False, deleted=False, clean=False,
                unknown=False, ignored=False, copies=False,
-               subrepos=False, include=None, exclude=None):
+               subrepos=False, include=None, exclude=None, files=None):
         """
         Return status of files in the repository as a list of (code, file path)
         where code can be:
@@ -1473,7 +2130,50 @@ class hgclient(object):
         subrepos - recurse into subrepositories
         include - include names matching the given patterns
         exclude - exclude names matching the given patterns
-        """
+        files - only show the status of these files, with their paths
+        relative to the repository's root
+        """
+        args = self._statusargs(rev, change, all, modified, added, removed,
+                                deleted, clean, unknown, ignored, copies,
+                                subrepos, include, exclude)
+
+        if files is not None:
+            return self._rawstatus(args, [
+                f if isinstance(f, bytes) else
+                f.encode(sys.getfilesystemencoding()) for f in files])
+        if (self._watcher is not None and self._watcher.watching and
+            args == self._statusargs()):
+            return self._watcher.status(
+                lambda files: self._rawstatus(args, files))
+        return self._rawstatus(args)
+
+    def _rawstatus(self, args, files=None):
+        if files is not None:
+            # paths stay relative to the root when files are given
+            args = args + [b('--config'), b('ui.relative-paths=no')] + files
+        out = self.rawcommand(args)
+        l = []
+
+        for entry in out.split(b('\0')):
+            if entry:
+                l.append(self._parsestatusentry(entry))
+
+        return l
+
+    def iterstatus(self, *args, **kwargs):
+        """Like status(), but yields the (code, file path) tuples as the
+        output arrives. See iterrawcommand() for the restrictions while
+        iterating."""
+        args = self._statusargs(*args, **kwargs)
+
+        for entry in util.splitchunks(self.iterrawcommand(args), b('\0')):
+            if entry:
+                yield self._parsestatusentry(entry)
+
+    def _statusargs(self, rev=None, change=None, all=False, modified=False,
+                    added=False, removed=False, deleted=False, clean=False,
+                    unknown=False, ignored=False, copies=False,
+                    subrepos=False, include=None, exclude=None):
         if rev and change:
             raise ValueError('cannot specify both rev and change')
 
@@ -1483,18 +2183,13 @@ class hgclient(object):
                           X=exclude, hidden=self.hidden)
 
         args.append(b('-0'))
+        return args
 
-        out = self.rawcommand(args)
-        l = []
-
-        for entry in out.split(b('\0')):
-            if entry:
-                if entry[0:1] == b(' '):
-                    l.append((b(' '), entry[2:]))
-                else:
-                    l.append(tuple(entry.split(b(' '), 1)))
-
-        return l
+    @staticmethod
+    def _parsestatusentry(entry):
+        if entry[0:1] == b(' '):
+            return b(' '), entry[2:]
+        return tuple(entry.split(b(' '), 1))
 
     def tag(self, names, rev=None, message=None, force=False, local=False,
             remove=False, date=None, user=None):
@@ -1523,8 +2218,9 @@ class hgclient(object):
                           remove=remove, d=date, u=user, hidden=self.hidden,
                           *names)
 
-        self.rawcommand(args)
+        self.rawcommand(args, keepoutput=False)
 
+    @cached
     def tags(self):
         """
         Return a list of repository tags as: (name, rev, node, islocal)
@@ -1569,6 +2265,43 @@ class hgclient(object):
             output = [i.split(b(': '))for i in out.strip().split(b('\n'))]
             return [(int(num), phase) for (num, phase) in output]
 
+    # the phase names are shared by all the results of phases()
+    _phasenames = dict((p, p) for p in (b('public'), b('draft'), b('secret')))
+
+    def phases(self, revrange):
+        """
+        Return {rev: (phase, hidden)} for all the revisions in revrange,
+        hidden ones included, read by a single log command.
+
+        The results are kept until the repository's changesets change (see
+        repostate.storefingerprint()) and serve changectx.phase() and
+        changectx.hidden() meanwhile.
+        """
+        args = cmdbuilder(b('log'), template=templates.phase, r=revrange,
+                          hidden=True)
+        fingerprint = repostate.storefingerprint(self._reporoot())
+        out = self.rawcommand(args).split(b('\0'))[:-1]
+
+        names = self._phasenames
+        result = {}
+        for rev, phase, hidden in util.grouper(3, out):
+            result[int(rev)] = (names.get(phase, phase), hidden == b('hidden'))
+        known, phases = self._phases
+        if known != fingerprint:
+            phases = {}
+        phases.update(result)
+        self._phases = (fingerprint, phases)
+        return result
+
+    def _knownphase(self, rev):
+        """(phase, hidden) of rev if a phases() call returned it since the
+        changesets last changed, None otherwise"""
+        known, phases = self._phases
+        if rev not in phases or (
+                known != repostate.storefingerprint(self._reporoot())):
+            return None
+        return phases[rev]
+
     def summary(self, remote=False):
         """
         Return a dictionary with a brief summary of the working directory state,
@@ -1655,6 +2388,14 @@ class hgclient(object):
         changeset most recently added to the repository (and therefore the most
         recently changed head).
         """
+        cl = self._changelogreader(text=True)
+        if cl is not None and len(cl):
+            try:
+                tip = cl.tip()
+                return self._tagged(cl[tip], self._nodetags(tip, cl.node(tip)))
+            except error.FormatError:
+                pass
+
         args = cmdbuilder(b('tip'), template=templates.changeset,
                           hidden=self.hidden)
         out = self.rawcommand(args)
@@ -1662,6 +2403,30 @@ class hgclient(object):
 
         return self._parserevs(out)[0]
 
+    def isancestor(self, ancestor, descendant):
+        """
+        Return True if ancestor is an ancestor of descendant or descendant
+        itself. Both are revision numbers or full hex nodes.
+        """
+        if ancestor in (-1, b('0') * 40):
+            # the null revision, which revsets don't include
+            return True
+        cl = self._changelogreader()
+        if cl is not None:
+            revs = [r if isinstance(r, util.integertypes) else cl.rev(r)
+                    for r in (ancestor, descendant)]
+            if None not in revs and all(-1 <= r < len(cl) for r in revs):
+                return cl.isancestor(*revs)
+
+        def spec(r):
+            if isinstance(r, util.integertypes):
+                return strtobytes(r)
+            return r
+        args = cmdbuilder(b('log'), template=b('{rev}'),
+                          r=spec(ancestor) + b(' and ::') + spec(descendant),
+                          hidden=self.hidden)
+        return bool(self.rawcommand(args))
+
     def update(self, rev=None, clean=False, check=False, date=None):
         """
         Update the repository's working directory to changeset specified by rev.
@@ -1715,7 +2480,7 @@ class hgclient(object):
 
     def __getitem__(self, changeid):
         try:
-            return context.changectx(self, changeid)
+            return self._changectx(changeid)
         except ValueError as e:
             raise KeyError(*e.args)
 
@@ -1724,8 +2489,16 @@ class hgclient(object):
         check if changeid, which can be either a local revision number or a
         changeset id, matches a changeset in the client.
         """
+        # a 40 character tag or bookmark name is left to hg
+        if (self._nodeindex is not None and isinstance(changeid, bytes) and
+            len(changeid) == 40 and re.match(b('[0-9a-fA-F]{40}$'), changeid)):
+            rev = self.nodeindex().rev(changeid)
+            if rev is None:
+                return False
+            if self.hidden or not repostate.hasobsmarkers(self._reporoot()):
+                return True
         try:
-            context.changectx(self, changeid)
+            self._changectx(changeid)
             return True
         except ValueError:
             return False
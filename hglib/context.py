@@ -1,11 +1,110 @@
 import hglib.client  # Circular dependency.
-from hglib import util, templates
+from hglib import util, templates, revstore, repostate
 from hglib.error import CommandError
 from hglib.util import b, strtobytes, integertypes
 
 _nullcset = [b('-1'), b('0000000000000000000000000000000000000000'), b(''),
              b(''), b(''), b(''), b('')]
 
+class ctxcache(object):
+    """
+    Interns the changectx objects of a repository by node, so looking up a
+    changeset again returns the same object without running hg.
+
+    The data of a changeset never changes, but its tags, bookmarks, phase
+    and existence can: the draft ones are dropped when the changelog,
+    phases, obsolescence markers, bookmarks or local tags change (see
+    repostate.storefingerprint()). The public ones are kept, but forget
+    their tags, bookmarks and parents then, and are dropped too when a
+    strip changed their revision number. Both are evicted, the least
+    recently used first, when there are more than maxsize changesets.
+    stale counts the dropped ones, cache has the other counters.
+
+    The contexts run hg with the client that made them, so a cache
+    belongs to one client.
+    """
+    def __init__(self, maxsize=256):
+        self.cache = util.lrucache(maxsize)
+        self.stale = 0
+        # revision number -> node, valid for the fingerprint it was filled at
+        self._nodes = {}
+        self._nodesfingerprint = None
+
+    def get(self, repo, node):
+        entry = self.cache.get(node)
+        if entry is None:
+            return None
+        ctx, fingerprint = entry
+        current = repostate.storefingerprint(repo._reporoot())
+        if fingerprint != current:
+            if not ctx._public or self._rev(repo, node) != ctx._rev:
+                # a strip below it renumbers even a public changeset
+                self.cache.pop(node)
+                self.stale += 1
+                return None
+            # read again when asked for
+            for name in ('_tags', '_bookmarks', '_parents'):
+                ctx.__dict__.pop(name, None)
+            self.cache.put(node, (ctx, current))
+        return ctx
+
+    def _rev(self, repo, node):
+        """the current revision number of node, None if it's gone"""
+        cl = repo._changelogreader(visible=False)
+        if cl is not None:
+            return cl.rev(node)
+        try:
+            return int(repo.log(node, hidden=True)[0].rev)
+        except (CommandError, IndexError):
+            return None
+
+    def intern(self, repo, ctx):
+        """Return the cached context of ctx's changeset, caching ctx if
+        there's none."""
+        cached = self.get(repo, ctx._node)
+        if cached is not None:
+            return cached
+        fingerprint = repostate.storefingerprint(repo._reporoot())
+        self.cache.put(ctx._node, (ctx, fingerprint))
+        if fingerprint == self._nodesfingerprint:
+            self._nodes[ctx._rev] = ctx._node
+        return ctx
+
+    def _node(self, repo, rev):
+        fingerprint = repostate.storefingerprint(repo._reporoot())
+        if fingerprint != self._nodesfingerprint:
+            # a strip can renumber the revisions
+            self._nodes = {}
+            self._nodesfingerprint = fingerprint
+        return self._nodes.get(rev)
+
+    def lookup(self, repo, changeid):
+        """Return the context for changeid like changectx(repo, changeid)"""
+        if changeid == -1 or changeid == _nullcset[1]:
+            return changectx(repo, -1)
+        if isinstance(changeid, (hglib.client.revision,
+                                 revstore.lazyrevision)):
+            node = changeid.node
+        elif isinstance(changeid, bytes) and len(changeid) == 40:
+            node = changeid
+        elif isinstance(changeid, integertypes):
+            node = self._node(repo, changeid)
+            if node is None:
+                mirrored = repo._mirrorrevision(changeid)
+                if mirrored is not None:
+                    changeid, node = mirrored, mirrored.node
+        else:
+            node = None
+        if node is not None:
+            ctx = self.get(repo, node)
+            if ctx is not None:
+                return ctx
+        return self.intern(repo, changectx(repo, changeid))
+
+    def clear(self):
+        self.cache.clear()
+        self._nodes = {}
+
 class changectx(object):
     """A changecontext object makes access to data related to a particular
     changeset convenient."""
@@ -14,7 +113,7 @@ class changectx(object):
         if changeid == b(''):
             changeid = b('.')
         self._repo = repo
-        if isinstance(changeid, hglib.client.revision):
+        if isinstance(changeid, (hglib.client.revision, revstore.lazyrevision)):
             cset = changeid
         elif changeid == -1:
             cset = _nullcset
@@ -51,6 +150,28 @@ class changectx(object):
 
         self._ignored = None
         self._clean = None
+        # public changesets can't change, see ctxcache
+        self._public = False
+        # filled by _fill() for the contexts from hgclient.changectxs()
+        self._parentnodes = None
+        self._phase = None
+        self._hidden = None
+        self._obsolete = None
+
+    def _fill(self, fields):
+        """set the data read with the fields of templates.changesetext that
+        follow those of templates.changeset"""
+        p1, p2, phase, bookmarks, adds, mods, dels, hidden, obsolete = fields
+        self._parentnodes = [p for p in (p1, p2) if p != _nullcset[1]]
+        self._phase = phase
+        self._public = phase == b('public')
+        self._bookmarks = bookmarks.split()
+        self._status = (mods.split(b('\n')) if mods else [],
+                        adds.split(b('\n')) if adds else [],
+                        dels.split(b('\n')) if dels else [],
+                        [])
+        self._hidden = hidden == b('hidden')
+        self._obsolete = obsolete == b('obsolete')
 
     def __str__(self):
         return self._node[:12].decode('latin-1')
@@ -124,6 +245,15 @@ class changectx(object):
     def node(self):
         return self._node
 
+    @util.propertycache
+    def _tags(self):
+        tags = self._repo.log(self._node)[0][2].split()
+        try:
+            tags.remove(b('tip'))
+        except ValueError:
+            pass
+        return tags
+
     def tags(self):
         return self._tags
 
@@ -180,10 +310,19 @@ class changectx(object):
     @util.propertycache
     def _parents(self):
         """return contexts for each parent changeset"""
+        if self._parentnodes is not None:
+            if not self._parentnodes:
+                return [changectx(self._repo, -1)]
+            return [self._repo._changectx(node) for node in self._parentnodes]
+        if self._repo._mirrored(self._rev):
+            par = [p for p in self._repo._mirror.parents(self._rev) if p != -1]
+            if not par:
+                return [changectx(self._repo, -1)]
+            return [self._repo._changectx(p) for p in par]
         par = self._repo.parents(rev=strtobytes(self))
         if not par:
             return [changectx(self._repo, -1)]
-        return [changectx(self._repo, int(cset.rev)) for cset in par]
+        return [self._repo._changectx(cset) for cset in par]
 
     def parents(self):
         return self._parents
@@ -210,29 +349,49 @@ class changectx(object):
 
     def hidden(self):
         """return True if the changeset is hidden, else False"""
+        if self._hidden is not None:
+            return self._hidden
+        known = self._repo._knownphase(self._rev)
+        if known is not None:
+            return known[1]
         return bool(self._repo.log(revrange=self._node + b(' and hidden()'),
                                    hidden=True))
 
     def phase(self):
         """return the phase of the changeset (public, draft or secret)"""
-        return self._repo.phase(strtobytes(self._rev))[0][1]
+        if self._phase is not None:
+            return self._phase
+        known = self._repo._knownphase(self._rev)
+        if known is not None:
+            self._public = known[0] == b('public')
+            return known[0]
+        phase = self._repo.phase(strtobytes(self._rev))[0][1]
+        self._public = phase == b('public')
+        return phase
+
+    def obsolete(self):
+        """return True if the changeset is obsolete, else False"""
+        if self._obsolete is not None:
+            return self._obsolete
+        return bool(self._repo.log(revrange=self._node + b(' and obsolete()'),
+                                   hidden=True))
 
     def children(self):
         """return contexts for each child changeset"""
-        for c in self._repo.log(b('children(') + self._node + b(')')):
-            yield changectx(self._repo, c)
+        for c in self._repo.changectxs(b('children(') + self._node + b(')')):
+            yield c
 
     def ancestors(self):
-        for a in self._repo.log(b('ancestors(') + self._node + b(')')):
-            yield changectx(self._repo, a)
+        for a in self._repo.changectxs(b('ancestors(') + self._node + b(')')):
+            yield a
 
     def descendants(self):
-        for d in self._repo.log(b('descendants(') + self._node + b(')')):
-            yield changectx(self._repo, d)
+        for d in self._repo.changectxs(b('descendants(') + self._node + b(')')):
+            yield d
 
     def ancestor(self, c2):
         """
         return the ancestor context of self and c2
         """
-        return changectx(self._repo,
-                         b('ancestor(') + self + b(', ') + c2 + b(')'))
+        return self._repo._changectx(
+            b('ancestor(') + self + b(', ') + c2 + b(')'))
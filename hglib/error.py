@@ -16,3 +16,7 @@ class ResponseError(ServerError, ValueError):
 
 class CapabilityError(ServerError):
     pass
+
+class FormatError(ValueError):
+    """A file in .hg is in a format that can't be read without hg"""
+    pass
@@ -0,0 +1,255 @@
+"""A copy of a repository's changelog in files that are read in process."""
+import os, mmap, struct, binascii, datetime, threading
+import hglib.client  # Circular dependency.
+from hglib import error, repostate, util
+from hglib.util import b, cmdbuilder, strtobytes
+
+# rev, node, parents' revs, branch, author, description and date
+template = b('{rev}\\0{node}\\0{p1rev}\\0{p2rev}\\0{branch}\\0{author}'
+             '\\0{desc}\\0{date}\\0')
+
+MAGIC = b('hglibcl1')
+# node, p1, p2, date and the offset and length in the string file of the
+# branch, author and description
+recordstruct = struct.Struct('>20siidIIIIQI')
+
+class changelogmirror(object):
+    """
+    The revision number, node, parents, date, branch, author and
+    description of every changeset of the repository at root, hidden ones
+    included, kept in two files under .hg/cache: one of fixed-width
+    records indexed by revision number, one of the strings they point to,
+    where each branch and author is stored once. Both are memory-mapped,
+    so reading the history doesn't run hg or parse anything but the
+    records read.
+
+    update() appends the revisions added since the last one and rebuilds
+    the files when that one was stripped or rolled back. Reading waits
+    for an update running in another thread, which can remap the files.
+
+    Indexing returns the same revision tuples as hgclient.log(), but with
+    no tags: they aren't a property of the changesets.
+    """
+    def __init__(self, root, name='hglib-changelog'):
+        self.root = root
+        d = os.path.join(repostate.hgdir(root), 'cache')
+        self._path = os.path.join(d, name)
+        self._strpath = self._path + '.d'
+        # update() reads the records too
+        self._lock = threading.RLock()
+        self._records = self._strings = b('')
+        self._maps = []
+        self._len = 0
+        self._stat = None
+        # stat data of the files when they were mapped
+        self._files = None
+        # string -> (offset, length) of the branches and authors
+        self._interned = None
+        self.builds = self.updates = 0
+        self._map()
+
+    def _unmap(self):
+        for m in self._maps:
+            m.close()
+        self._maps = []
+        self._records = self._strings = b('')
+        self._len = 0
+        self._files = None
+
+    def _filestat(self):
+        return repostate._stat(self._path), repostate._stat(self._strpath)
+
+    def _map(self):
+        self._unmap()
+        self._files = self._filestat()
+        try:
+            records = open(self._path, 'rb')
+            strings = open(self._strpath, 'rb')
+        except IOError:
+            return
+        with records:
+            with strings:
+                if records.read(len(MAGIC)) != MAGIC:
+                    return
+                self._records = self._mmap(records)
+                self._strings = self._mmap(strings)
+        # drop a record whose strings weren't all written
+        n = (len(self._records) - len(MAGIC)) // recordstruct.size
+        while n and self._end(n - 1) > len(self._strings):
+            n -= 1
+        self._len = n
+
+    def _mmap(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return b('')
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        return m
+
+    def _record(self, rev):
+        return recordstruct.unpack_from(self._records,
+                                        len(MAGIC) + rev * recordstruct.size)
+
+    def _end(self, rev):
+        r = self._record(rev)
+        return max(r[4] + r[5], r[6] + r[7], r[8] + r[9])
+
+    def __len__(self):
+        return self._len
+
+    def _string(self, offset, length):
+        return bytes(self._strings[offset:offset + length])
+
+    def _check(self, rev):
+        if rev < 0:
+            rev += len(self)
+        if not 0 <= rev < len(self):
+            raise IndexError('revision %d not mirrored' % rev)
+        return rev
+
+    def __getitem__(self, rev):
+        if isinstance(rev, slice):
+            return [self[r] for r in range(*rev.indices(len(self)))]
+        with self._lock:
+            rev = self._check(rev)
+            node, p1, p2, date, boff, blen, aoff, alen, doff, dlen = \
+                self._record(rev)
+            return hglib.client.revision(
+                strtobytes(rev), binascii.hexlify(node), b(''),
+                self._string(boff, blen), self._string(aoff, alen),
+                self._string(doff, dlen),
+                datetime.datetime.fromtimestamp(date))
+
+    def __iter__(self):
+        for rev in range(len(self)):
+            yield self[rev]
+
+    def node(self, rev):
+        """the hex node of rev"""
+        with self._lock:
+            return binascii.hexlify(self._record(self._check(rev))[0])
+
+    def parents(self, rev):
+        """the revision numbers of the parents of rev, -1 for none"""
+        with self._lock:
+            r = self._record(self._check(rev))
+        return r[1], r[2]
+
+    def update(self, client):
+        """
+        Bring the files up to date with the repository of client. When
+        they can't be written (a read-only repository, a full disk...),
+        nothing is mirrored until the changelog changes again.
+        """
+        with self._lock:
+            store = repostate.storedir(self.root)
+            st = (repostate._stat(os.path.join(store, '00changelog.i')),
+                  repostate._stat(os.path.join(store, '00changelog.d')))
+            if st == self._stat:
+                return
+            try:
+                d = os.path.dirname(self._path)
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                # other processes would append the same revisions
+                with util.filelock(self._path + '.lock'):
+                    if self._filestat() != self._files:
+                        # written by another process since they were mapped
+                        self._interned = None
+                        self._map()
+                    self._update(client)
+            except (IOError, OSError):
+                self._unmap()
+            self._stat = st
+
+    def _update(self, client):
+        last = len(self) - 1
+        entries = None
+        if len(self._records) != len(MAGIC) + len(self) * recordstruct.size:
+            # a record was cut short, start over
+            last = -1
+        if last >= 0:
+            try:
+                entries = self._log(client, strtobytes(last) + b(':'))
+            except error.CommandError:
+                # the last revision is gone
+                entries = None
+            if not entries or entries[0][1] != self.node(last):
+                entries = None
+            else:
+                entries = entries[1:]
+        if entries is None:
+            entries = self._log(client, b('all()'))
+            self._write(entries, rebuild=True)
+            self.builds += 1
+        elif entries:
+            self._write(entries)
+            self.updates += 1
+
+    def _log(self, client, revrange):
+        args = cmdbuilder(b('log'), template=template, r=revrange,
+                          hidden=True)
+        out = client.rawcommand(args).split(b('\0'))[:-1]
+        return [out[i:i + 8] for i in range(0, len(out), 8)]
+
+    def _write(self, entries, rebuild=False):
+        if rebuild or self._interned is None:
+            self._interned = {}
+            if not rebuild:
+                for rev in range(len(self)):
+                    r = self._record(rev)
+                    self._interned[self._string(r[4], r[5])] = r[4], r[5]
+                    self._interned[self._string(r[6], r[7])] = r[6], r[7]
+        if rebuild:
+            # written aside and renamed so readers never see half of it
+            path, strpath = self._path + '.tmp', self._strpath + '.tmp'
+            mode = 'wb'
+            offset = 0
+        else:
+            path, strpath = self._path, self._strpath
+            mode = 'ab'
+            offset = len(self._strings)
+        records = []
+        strings = []
+        end = [offset]
+
+        def add(s):
+            start = end[0]
+            strings.append(s)
+            end[0] += len(s)
+            return start, len(s)
+
+        def intern(s):
+            if s not in self._interned:
+                self._interned[s] = add(s)
+            return self._interned[s]
+
+        for rev, node, p1, p2, branch, author, desc, date in entries:
+            boff, blen = intern(branch)
+            aoff, alen = intern(author)
+            doff, dlen = add(desc)
+            # truncate the timezone like hgclient._parserev()
+            posixtime = float(date.split(b('.'), 1)[0])
+            records.append(recordstruct.pack(
+                binascii.unhexlify(node), int(p1), int(p2), posixtime,
+                boff, blen, aoff, alen, doff, dlen))
+        # the strings first, a record is only valid once they're written
+        with open(strpath, mode) as f:
+            f.write(b('').join(strings))
+        with open(path, mode) as f:
+            if rebuild:
+                f.write(MAGIC)
+            f.write(b('').join(records))
+        if rebuild:
+            # mapped files can't be replaced everywhere
+            self._unmap()
+            for src, dst in ((strpath, self._strpath), (path, self._path)):
+                if os.name == 'nt' and os.path.exists(dst):
+                    os.unlink(dst)
+                os.rename(src, dst)
+        self._map()
+
+    def close(self):
+        with self._lock:
+            self._unmap()
@@ -0,0 +1,156 @@
+"""An in-process index of a repository's changeset nodes."""
+import os, array, binascii, bisect, threading
+from hglib import error, repostate
+from hglib.util import b, cmdbuilder, strtobytes
+
+class _nodes(object):
+    """the nodes of a packed buffer of 20-byte nodes, as a sequence for
+    bisect"""
+    def __init__(self, buf):
+        self._buf = buf
+
+    def __len__(self):
+        return len(self._buf) // 20
+
+    def __getitem__(self, i):
+        return bytes(self._buf[i * 20:i * 20 + 20])
+
+class nodeindex(object):
+    """
+    The nodes of all the changesets of a repository, hidden ones included,
+    packed in a sorted buffer of 20-byte binary nodes with the revision
+    number of each, so that checking whether a node exists and resolving a
+    short hash take a binary search instead of a command.
+
+    It's filled by update() with a log of the whole changelog, and then
+    with a log of the revisions added since, when the changelog changes on
+    disk. It's rebuilt when revisions were stripped or rolled back.
+    builds and updates count those two.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        self._revs = array.array('l')
+        self._tiprev = -1
+        self._tipnode = None
+        self._stat = None
+        self._lock = threading.Lock()
+        self.builds = self.updates = 0
+
+    def __len__(self):
+        return len(self._revs)
+
+    def _changelogstat(self, root):
+        store = repostate.storedir(root)
+        return (repostate._stat(os.path.join(store, '00changelog.i')),
+                repostate._stat(os.path.join(store, '00changelog.d')))
+
+    def _log(self, client, revrange):
+        args = cmdbuilder(b('log'), template=b('{rev}\\0{node}\\0'),
+                          r=revrange, hidden=True)
+        out = client.rawcommand(args).split(b('\0'))[:-1]
+        return [(int(out[i]), binascii.unhexlify(out[i + 1]))
+                for i in range(0, len(out), 2)]
+
+    def update(self, client):
+        """bring the index up to date with the repository of client"""
+        with self._lock:
+            st = self._changelogstat(client._reporoot())
+            if st == self._stat:
+                return
+            entries = None
+            if self._tipnode is not None:
+                try:
+                    entries = self._log(client,
+                                        strtobytes(self._tiprev) + b(':'))
+                except error.CommandError:
+                    # the old tip is gone
+                    entries = None
+                if not entries or entries[0] != (self._tiprev, self._tipnode):
+                    entries = None
+                else:
+                    entries = entries[1:]
+            if entries is None:
+                self._buf = bytearray()
+                self._revs = array.array('l')
+                self._tiprev, self._tipnode = -1, None
+                entries = self._log(client, b('all()'))
+                self.builds += 1
+            else:
+                self.updates += 1
+            self._insert(entries)
+            self._stat = st
+
+    def _insert(self, entries):
+        if not self._revs:
+            # a single sort when building
+            entries = sorted(entries, key=lambda e: e[1])
+            self._buf = bytearray(b('').join(node for rev, node in entries))
+            self._revs = array.array('l', [rev for rev, node in entries])
+        else:
+            # merge the sorted new nodes in a single copy of the buffer
+            nodes = _nodes(self._buf)
+            bufs, revs = [], array.array('l')
+            last = 0
+            for rev, node in sorted(entries, key=lambda e: e[1]):
+                i = bisect.bisect_left(nodes, node, last)
+                bufs.append(self._buf[last * 20:i * 20])
+                bufs.append(node)
+                revs.extend(self._revs[last:i])
+                revs.append(rev)
+                last = i
+            bufs.append(self._buf[last * 20:])
+            revs.extend(self._revs[last:])
+            self._buf = bytearray().join(bufs)
+            self._revs = revs
+        for rev, node in entries:
+            if rev > self._tiprev:
+                self._tiprev, self._tipnode = rev, node
+
+    def rev(self, node):
+        """the revision number of node (hex or binary), None if it's not in
+        the repository"""
+        if len(node) == 40:
+            try:
+                node = binascii.unhexlify(node)
+            except (TypeError, ValueError, binascii.Error):
+                return None
+        with self._lock:
+            nodes = _nodes(self._buf)
+            i = bisect.bisect_left(nodes, node)
+            if i < len(nodes) and nodes[i] == node:
+                return self._revs[i]
+        return None
+
+    def __contains__(self, node):
+        return self.rev(node) is not None
+
+    def resolve(self, prefix):
+        """
+        Return the hex node starting with the hex prefix, None if there's
+        none. Raise ValueError if there's more than one.
+
+        Unlike hg, this doesn't consider tags, bookmarks and branch names.
+        """
+        prefix = prefix.lower()
+        try:
+            low = binascii.unhexlify(prefix + b('0') * (40 - len(prefix)))
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        found = []
+        with self._lock:
+            nodes = _nodes(self._buf)
+            i = bisect.bisect_left(nodes, low)
+            while i < len(nodes) and len(found) < 2:
+                node = binascii.hexlify(nodes[i])
+                if not node.startswith(prefix):
+                    break
+                found.append(node)
+                i += 1
+        if len(found) > 1:
+            raise ValueError('ambiguous identifier %r' % prefix)
+        return found[0] if found else None
+
+    @property
+    def tip(self):
+        """(rev, binary node) of the last revision, (-1, None) if empty"""
+        return self._tiprev, self._tipnode
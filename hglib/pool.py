@@ -0,0 +1,204 @@
+import threading, types
+from hglib import client, nodeindex, revlog, util, watcher
+from hglib.mirror import changelogmirror
+
+# hgclient methods that change neither the repository nor the working
+# directory and so can run in parallel with each other. The iter* methods
+# aren't: their command runs after run() gave the client back. annotate
+# and manifest are generators too, run() collects them with their client.
+readonly = frozenset([
+    'annotate', 'bookmarks', 'branches', 'cat', 'config', 'diff', 'grep',
+    'heads', 'identify', 'incoming', 'log', 'manifest', 'outgoing',
+    'parents', 'paths', 'root', 'status', 'summary', 'tags', 'tip',
+    'version',
+])
+
+class clientpool(object):
+    """A pool of command servers for one repository.
+
+    Read-only commands get an idle client each and run in parallel, the
+    pool opens new clients up to size when all of them are busy. Other
+    commands are exclusive: they wait for the running commands to finish
+    and no command starts until they're done. Waiting exclusive commands
+    take precedence over new read-only ones.
+
+    factory - a callable returning a new client, used instead of opening
+    one with the other arguments
+    cachesize - the number of read-only command results cached for all the
+    clients, see hgclient.setcache()
+    watch - when given, the clients' status() is limited to the paths
+    touched since its last call, watch being the seconds between full
+    statuses, see watcher.dirtywatcher. Ignored where inotify isn't
+    available.
+    nodes - look nodes up in a nodeindex.nodeindex shared by the clients,
+    see hgclient.setnodeindex()
+    changelog - answer tip(), parents() and isancestor() from a
+    revlog.changelog shared by the clients, see hgclient.setchangelog()
+    mirror - read revisions from a mirror.changelogmirror shared by the
+    clients, see hgclient.setmirror(). It writes to .hg/cache.
+    """
+    def __init__(self, path=None, size=4, encoding=None, configs=None,
+                 socketpath=None, factory=None, cachesize=0, watch=0,
+                 nodes=False, changelog=False, mirror=False):
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+        self._path = path
+        self._size = size
+        self._hgencoding = encoding
+        self._configs = configs
+        self._socketpath = socketpath
+        self._factory = factory
+        # shared by all the clients, see hgclient.setcache()
+        self.cache = util.lrucache(cachesize) if cachesize else None
+        # shared by all the clients, see hgclient.setnodeindex()
+        self.nodeindex = nodeindex.nodeindex() if nodes else None
+        # shared by all the clients, see hgclient.setwatcher()
+        self.watcher = None
+        # shared by all the clients, see hgclient.setchangelog()
+        self.changelog = None
+        # shared by all the clients, see hgclient.setmirror()
+        self.mirror = None
+
+        self._cond = threading.Condition()
+        # all the open clients, idle or not
+        self._clients = set()
+        self._idle = [self._open()]
+        root = self._idle[0]._reporoot()
+        if changelog:
+            self.changelog = revlog.changelog(root)
+            self._idle[0].setchangelog(self.changelog)
+        if mirror:
+            self.mirror = changelogmirror(root)
+            self._idle[0].setmirror(self.mirror)
+        if watch and watcher.available():
+            self.watcher = watcher.dirtywatcher(root, reconcile=watch)
+            self._idle[0].setwatcher(self.watcher)
+        # the servers' encoding, see hgclient.encoding
+        self.encoding = self._idle[0].encoding
+        self._count = 1
+        self._readers = 0
+        self._writer = False
+        self._waitingwriters = 0
+        self._closed = False
+
+    def _open(self):
+        if self._factory is not None:
+            c = self._factory()
+        else:
+            c = client.hgclient(self._path, self._hgencoding, self._configs,
+                                socketpath=self._socketpath)
+        c.setcache(self.cache)
+        c.setnodeindex(self.nodeindex)
+        c.setwatcher(self.watcher)
+        c.setchangelog(self.changelog)
+        c.setmirror(self.mirror)
+        with self._cond:
+            self._clients.add(c)
+        return c
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def pids(self):
+        """the known process ids of the pool's command servers"""
+        with self._cond:
+            return set(c.pid for c in self._clients if c.pid is not None)
+
+    @property
+    def busy(self):
+        """number of clients running a command"""
+        return self._readers + int(self._writer)
+
+    def _wait(self, blocked):
+        while not self._closed and blocked():
+            self._cond.wait()
+        if self._closed:
+            raise ValueError('pool closed')
+
+    def acquire(self, readonly=True):
+        """Return a client to run a command with, blocking while the command
+        can't run yet. The client has to be given back with release()."""
+        with self._cond:
+            if readonly:
+                self._wait(lambda: self._writer or self._waitingwriters or
+                           (not self._idle and self._count >= self._size))
+                self._readers += 1
+            else:
+                self._waitingwriters += 1
+                try:
+                    self._wait(lambda: self._writer or self._readers)
+                finally:
+                    self._waitingwriters -= 1
+                self._writer = True
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self._open()
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                if readonly:
+                    self._readers -= 1
+                else:
+                    self._writer = False
+                self._cond.notify_all()
+            raise
+
+    def release(self, c):
+        with self._cond:
+            if self._writer:
+                self._writer = False
+            else:
+                self._readers -= 1
+            if c.server is None or self._closed:
+                # a closed client is replaced by a new one on demand
+                self._count -= 1
+                self._clients.discard(c)
+            else:
+                self._idle.append(c)
+                c = None
+            self._cond.notify_all()
+        if c is not None and c.server is not None:
+            c.close()
+
+    def run(self, name, *args, **kwargs):
+        """run the hgclient method (or read the property) name on a client
+        from the pool. The results of generators like annotate() and
+        manifest() are returned as lists, read before the client is given
+        back. The iter* methods are refused, as they're meant to be
+        iterated as the output arrives: acquire a client for them
+        instead."""
+        if name.startswith('iter'):
+            raise ValueError('%s needs its client while iterating, use '
+                             'acquire() and release()' % name)
+        c = self.acquire(name in readonly)
+        try:
+            attr = getattr(c, name)
+            if not callable(attr):
+                return attr
+            result = attr(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                # the command runs when it's first iterated
+                result = list(result)
+            return result
+        finally:
+            self.release(c)
+
+    def close(self):
+        """Close the idle clients. Clients that are in use are closed when
+        they are released."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._clients.difference_update(idle)
+            self._closed = True
+            self._cond.notify_all()
+        for c in idle:
+            c.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.mirror is not None:
+            self.mirror.close()
@@ -0,0 +1,249 @@
+"""Cheap checks of a repository's state by looking at the files in .hg
+directly, without running hg."""
+import os, struct, binascii
+
+def hgdir(root):
+    return os.path.join(root, '.hg')
+
+def _sharedpath(root):
+    """the .hg directory of the share source, None if the repository isn't
+    shared"""
+    try:
+        with open(os.path.join(hgdir(root), 'sharedpath'), 'rb') as f:
+            return f.read().decode('utf-8').rstrip('\n')
+    except (IOError, OSError):
+        return None
+
+def storedir(root):
+    """Return the directory of the repository's store, following the
+    sharedpath of shared repositories"""
+    d = _sharedpath(root) or hgdir(root)
+    store = os.path.join(d, 'store')
+    if os.path.isdir(store):
+        return store
+    return d
+
+def bookmarksdir(root):
+    """Return the directory of the repository's bookmarks file, the share
+    source's .hg when it was shared with its bookmarks (hg share -B). The
+    active bookmark is never shared."""
+    d = hgdir(root)
+    source = _sharedpath(root)
+    if source is not None:
+        try:
+            with open(os.path.join(d, 'shared'), 'rb') as f:
+                if b'bookmarks' in f.read().split():
+                    return source
+        except (IOError, OSError):
+            pass
+    return d
+
+def _configfiles():
+    home = os.path.expanduser('~')
+    return [os.path.join(home, '.hgrc'),
+            os.path.join(home, 'mercurial.ini'),
+            os.path.join(home, '.config', 'hg', 'hgrc'),
+            '/etc/mercurial/hgrc']
+
+def statefiles(root):
+    """The files whose changes are tracked by fingerprint()"""
+    store = storedir(root)
+    d = hgdir(root)
+    return ([os.path.join(store, f) for f in ('00changelog.i', '00changelog.d',
+                                                '00changelog.n', 'phaseroots',
+                                                'obsstore')] +
+            [os.path.join(bookmarksdir(root), 'bookmarks')] +
+            [os.path.join(d, f) for f in ('bookmarks.current', 'dirstate',
+                                          'branch', 'localtags', 'hgrc')] +
+            _configfiles())
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_ctime, st.st_size, st.st_ino
+
+def fingerprint(root):
+    """
+    Return a value that changes whenever the changelog, phases,
+    obsolescence markers, bookmarks, active bookmark, dirstate, working
+    directory branch, local tags or the configuration of the repository at
+    root change.
+
+    It's made of stat data only, so it's cheap to compute but can miss a
+    change that keeps the size of a file within the resolution of its
+    mtime.
+    """
+    return tuple(_stat(f) for f in statefiles(root))
+
+nullid = b'\0' * 20
+
+# revlog header
+REVLOGV1 = 1
+FLAG_INLINE_DATA = 1 << 16
+INDEXENTRYSIZE = 64
+
+def _read(path, size=-1):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(size)
+    except (IOError, OSError):
+        return None
+
+def dirstateparents(root):
+    """Return the binary nodes of the working directory parents, None if
+    the dirstate format isn't known"""
+    data = _read(os.path.join(hgdir(root), 'dirstate'), 76)
+    if not data:
+        return nullid, nullid
+    if data.startswith(b'dirstate-v2\n'):
+        # the parents are padded to 32 bytes in the v2 docket
+        data = data[12:]
+        if len(data) < 64:
+            return None
+        return data[:20], data[32:52]
+    if len(data) < 40:
+        return None
+    return data[:20], data[20:40]
+
+def changelogtip(root):
+    """Return the binary node of the last revision in the changelog
+    (hidden or not), nullid for an empty one and None if the changelog
+    format isn't known"""
+    path = os.path.join(storedir(root), '00changelog.i')
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return nullid
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return nullid
+        f.seek(0)
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        header = struct.unpack('>I', header)[0]
+        if header & 0xFFFF != REVLOGV1:
+            return None
+        if header & FLAG_INLINE_DATA:
+            # the data of each revision follows its index entry
+            pos = last = 0
+            while pos + INDEXENTRYSIZE <= size:
+                f.seek(pos + 8)
+                complen = struct.unpack('>i', f.read(4))[0]
+                last = pos
+                pos += INDEXENTRYSIZE + complen
+            if pos != size:
+                return None
+        else:
+            if size % INDEXENTRYSIZE:
+                return None
+            last = size - INDEXENTRYSIZE
+        f.seek(last + 32)
+        node = f.read(20)
+        if len(node) < 20:
+            return None
+        return node
+
+def probe(root):
+    """
+    Read the working directory branch and parents and the changelog tip
+    of the repository at root directly from .hg, without running hg.
+
+    Return a dict with 'branch', 'parents' (binary nodes), 'tip' (binary
+    node), 'dirstate' (stat data of the dirstate) and 'store' (see
+    storefingerprint()), or None if some of it can't be read.
+    """
+    parents = dirstateparents(root)
+    tip = changelogtip(root)
+    if parents is None or tip is None:
+        return None
+    branch = _read(os.path.join(hgdir(root), 'branch'))
+    branch = (branch or b'').strip() or b'default'
+    return {
+        'branch': branch,
+        'parents': parents,
+        'tip': tip,
+        'dirstate': _stat(os.path.join(hgdir(root), 'dirstate')),
+        'store': storefingerprint(root),
+    }
+
+def dirstatekey(root):
+    """
+    Return a value that changes when the working directory parents or the
+    set of tracked files change (hg add, forget, commit, update...), but
+    not when hg status only records the clean files it looked up.
+    """
+    path = os.path.join(hgdir(root), 'dirstate')
+    data = _read(path, 4096)
+    if not data:
+        return None
+    if data.startswith(b'dirstate-v2\n'):
+        # the docket names the data file and its size
+        return data
+    st = _stat(path)
+    return data[:40], st and st[2]
+
+def storefingerprint(root):
+    """
+    Like fingerprint(), but only for the changelog, phases, obsolescence
+    markers, bookmarks and local tags: what can change about an existing
+    changeset.
+    """
+    store = storedir(root)
+    d = hgdir(root)
+    return tuple(_stat(f) for f in
+                 [os.path.join(store, f) for f in ('00changelog.i',
+                                                   '00changelog.n',
+                                                   'phaseroots', 'obsstore')] +
+                 [os.path.join(bookmarksdir(root), 'bookmarks'),
+                  os.path.join(d, 'localtags')])
+
+def hasobsmarkers(root):
+    """True if the repository has obsolescence markers, so that some of its
+    changesets can be hidden"""
+    st = _stat(os.path.join(storedir(root), 'obsstore'))
+    return bool(st and st[2])
+
+def _readtags(data):
+    """{name: binary node} of the "hex node name" lines of data, the last
+    line of a name winning like in hg"""
+    tags = {}
+    for line in data.splitlines():
+        try:
+            node, name = line.split(b' ', 1)
+            tags[name.strip()] = binascii.unhexlify(node)
+        except (TypeError, ValueError, binascii.Error):
+            continue
+    return tags
+
+def cachedtags(root, tiprev, tipnode, hidden=False):
+    """
+    Return the global tags of the repository, {name: binary node} with the
+    names in UTF-8, read from the tags cache hg writes when it reads them.
+    Removed tags point to nullid.
+
+    None if the cache wasn't written for the changelog ending at tiprev
+    and tipnode (binary), or if the repository has obsolescence markers:
+    the cache is also checked against the hidden changesets then.
+    hidden - the cache of the changesets including the hidden ones.
+    """
+    if hasobsmarkers(root):
+        return None
+    d = os.path.join(_sharedpath(root) or hgdir(root), 'cache')
+    data = _read(os.path.join(d, 'tags2' if hidden else 'tags2-visible'))
+    if not data:
+        return None
+    valid, data = (data.split(b'\n', 1) + [b''])[:2]
+    if valid.split() != [str(tiprev).encode('ascii'),
+                         binascii.hexlify(tipnode)]:
+        return None
+    return _readtags(data)
+
+def localtags(root):
+    """Return the local tags of the repository, {name: binary node} with
+    the names in hg's encoding"""
+    return _readtags(_read(os.path.join(hgdir(root), 'localtags')) or b'')
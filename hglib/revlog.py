@@ -0,0 +1,294 @@
+"""A read-only reader of a repository's changelog revlog."""
+import os, struct, binascii, codecs, datetime, threading, zlib
+import hglib.client  # Circular dependency.
+from hglib import error, repostate
+from hglib.util import b, strtobytes
+
+FLAG_GENERALDELTA = 1 << 17
+
+# offset and flags, compressed and uncompressed lengths, delta base, link
+# revision, parents and node of a revision in a version 1 index
+indexstruct = struct.Struct('>Qiiiiii20s12x')
+deltastruct = struct.Struct('>lll')
+
+def _patch(text, delta):
+    """apply a binary delta (a series of start, end, length headers each
+    followed by the data replacing text[start:end]) to text"""
+    out = []
+    last = pos = 0
+    while pos < len(delta):
+        start, end, length = deltastruct.unpack_from(delta, pos)
+        pos += deltastruct.size
+        out.append(text[last:start])
+        out.append(delta[pos:pos + length])
+        pos += length
+        last = end
+    out.append(text[last:])
+    return b('').join(out)
+
+def _decodeextra(text):
+    extra = {}
+    for item in text.split(b('\0')):
+        if item:
+            key, value = codecs.escape_decode(item)[0].split(b(':'), 1)
+            extra[key] = value
+    return extra
+
+class changelog(object):
+    """
+    The changelog of the repository at root read straight from
+    00changelog.i and 00changelog.d, so that the tip, the parents and the
+    ancestry of revisions and the mapping between nodes and revision
+    numbers are answered without running hg.
+
+    Only version 1 revlogs are read, inline or not, with or without
+    general delta. refresh() raises error.FormatError for other formats,
+    and reading a revision's text raises it for data compressed with
+    anything but zlib (zstd is hg's default since 5.8): the index stays
+    readable.
+
+    The index is kept in memory and refresh() only reads what was appended
+    to it, the data of a revision is read from 00changelog.d when needed.
+    Neither is memory-mapped: hg strip and rollback truncate them, and
+    reading a mapped page past the end of a file kills the process.
+
+    Like the revlog, it knows nothing of hidden changesets.
+    """
+    def __init__(self, root):
+        self.root = root
+        store = repostate.storedir(root)
+        self._indexpath = os.path.join(store, '00changelog.i')
+        self._datapath = os.path.join(store, '00changelog.d')
+        # refresh() replaces the index the readers use: they take it too,
+        # for as long as they need the same index
+        self._lock = threading.RLock()
+        self._stat = None
+        self._index = bytearray()
+        self._inline = False
+        self._generaldelta = False
+        self._len = 0
+        # index offsets of the entries of an inline revlog
+        self._positions = []
+        # binary node -> rev, filled on demand
+        self._nodemap = {}
+        self._mapped = 0
+        self.reads = self.rereads = 0
+
+    def _readindex(self):
+        """read what was appended to the index since the last time, or all
+        of it when it was rewritten"""
+        try:
+            f = open(self._indexpath, 'rb')
+        except IOError:
+            # no revision yet
+            self._reset(bytearray())
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            old = len(self._index)
+            if old and size >= old and self._len:
+                # still the same history if the first and the last entry
+                # read didn't change
+                last = self._entrypos(self._len - 1)
+                f.seek(last)
+                if (f.read(repostate.INDEXENTRYSIZE) ==
+                    bytes(self._index[last:last + repostate.INDEXENTRYSIZE])):
+                    f.seek(0)
+                    if (f.read(repostate.INDEXENTRYSIZE) ==
+                        bytes(self._index[:repostate.INDEXENTRYSIZE])):
+                        f.seek(old)
+                        self._index += f.read(size - old)
+                        self.reads += 1
+                        return
+            f.seek(0)
+            self._reset(bytearray(f.read(size)))
+            self.rereads += 1
+
+    def _reset(self, index):
+        self._index = index
+        self._positions = []
+        self._nodemap = {}
+        self._mapped = 0
+        self._len = 0
+
+    def refresh(self):
+        """Read the changes to the changelog since the last call. Raise
+        error.FormatError if its format isn't supported."""
+        with self._lock:
+            st = (repostate._stat(self._indexpath),
+                  repostate._stat(self._datapath))
+            if st == self._stat:
+                return
+            self._readindex()
+            index = self._index
+            inline = generaldelta = False
+            if len(index) >= 4:
+                header = struct.unpack_from('>I', index)[0]
+                if header & 0xFFFF != repostate.REVLOGV1:
+                    raise error.FormatError('unsupported revlog version %d' %
+                                            (header & 0xFFFF))
+                if header & ~0xFFFF & ~(repostate.FLAG_INLINE_DATA |
+                                        FLAG_GENERALDELTA):
+                    raise error.FormatError('unsupported revlog flags %#x' %
+                                            (header & ~0xFFFF))
+                inline = bool(header & repostate.FLAG_INLINE_DATA)
+                generaldelta = bool(header & FLAG_GENERALDELTA)
+            if inline:
+                # each entry is followed by its data, and an entry being
+                # written is ignored
+                pos = (self._positions[-1] + repostate.INDEXENTRYSIZE +
+                       self._complen(self._positions[-1])
+                       if self._positions else 0)
+                while pos + repostate.INDEXENTRYSIZE <= len(index):
+                    end = (pos + repostate.INDEXENTRYSIZE +
+                           self._complen(pos))
+                    if end > len(index):
+                        break
+                    self._positions.append(pos)
+                    pos = end
+                length = len(self._positions)
+            else:
+                self._positions = []
+                length = len(index) // repostate.INDEXENTRYSIZE
+            self._inline = inline
+            self._generaldelta = generaldelta
+            self._len = length
+            self._stat = st
+
+    def _complen(self, pos):
+        return struct.unpack_from('>i', self._index, pos + 8)[0]
+
+    def _entrypos(self, rev):
+        if self._inline:
+            return self._positions[rev]
+        return rev * repostate.INDEXENTRYSIZE
+
+    def __len__(self):
+        with self._lock:
+            return self._len
+
+    def _entry(self, rev):
+        with self._lock:
+            if not 0 <= rev < self._len:
+                raise IndexError('revision %d not in the changelog' % rev)
+            return indexstruct.unpack_from(self._index, self._entrypos(rev))
+
+    def tip(self):
+        """the revision number of the last revision, hidden or not, -1 for
+        an empty changelog"""
+        with self._lock:
+            return self._len - 1
+
+    def node(self, rev):
+        """the hex node of rev"""
+        if rev == -1:
+            return binascii.hexlify(repostate.nullid)
+        return binascii.hexlify(self._entry(rev)[7])
+
+    def rev(self, node):
+        """the revision number of node (hex or binary), None if it's not in
+        the changelog"""
+        if len(node) == 40:
+            try:
+                node = binascii.unhexlify(node)
+            except (TypeError, ValueError, binascii.Error):
+                return None
+        if node == repostate.nullid:
+            return -1
+        with self._lock:
+            rev = self._nodemap.get(node)
+            if rev is None and self._mapped < self._len:
+                for r in range(self._mapped, self._len):
+                    self._nodemap[self._entry(r)[7]] = r
+                self._mapped = self._len
+                rev = self._nodemap.get(node)
+        return rev
+
+    def parents(self, rev):
+        """the revision numbers of the parents of rev, -1 for none"""
+        entry = self._entry(rev)
+        return entry[5], entry[6]
+
+    def isancestor(self, a, b):
+        """True if revision a is an ancestor of revision b or b itself"""
+        if a == -1 or a == b:
+            return True
+        if a > b:
+            # a revision's ancestors all have lower numbers
+            return False
+        seen = set([b])
+        visit = [b]
+        with self._lock:
+            while visit:
+                for p in self.parents(visit.pop()):
+                    if p == a:
+                        return True
+                    if p > a and p not in seen:
+                        seen.add(p)
+                        visit.append(p)
+        return False
+
+    def _chunk(self, rev):
+        with self._lock:
+            entry = self._entry(rev)
+            start = entry[0] >> 16 if rev else 0
+            if self._inline:
+                start += (rev + 1) * repostate.INDEXENTRYSIZE
+                data = bytes(self._index[start:start + entry[1]])
+            else:
+                try:
+                    with open(self._datapath, 'rb') as f:
+                        f.seek(start)
+                        data = f.read(entry[1])
+                except IOError:
+                    data = b('')
+        if len(data) != entry[1]:
+            raise error.FormatError('revision %d is truncated' % rev)
+        if not data:
+            return b('')
+        kind = data[:1]
+        if kind == b('x'):
+            return zlib.decompress(data)
+        if kind == b('u'):
+            return data[1:]
+        if kind == b('\0'):
+            return data
+        raise error.FormatError('unsupported compression %r' % kind)
+
+    def revision(self, rev):
+        """the raw text of rev, as stored in the changelog"""
+        chain = []
+        with self._lock:
+            while True:
+                chain.append(rev)
+                base = self._entry(rev)[3]
+                if base == rev or base == -1:
+                    break
+                rev = base if self._generaldelta else rev - 1
+            chunks = [self._chunk(r) for r in reversed(chain)]
+        text = chunks[0]
+        for chunk in chunks[1:]:
+            text = _patch(text, chunk)
+        return text
+
+    def __getitem__(self, rev):
+        """
+        the revision tuple of rev like hgclient.log() returns, but with no
+        tags and the fields as stored in the changelog, in UTF-8
+        """
+        with self._lock:
+            if rev < 0:
+                rev += len(self)
+            text = self.revision(rev)
+            node = self.node(rev)
+        header, desc = text.split(b('\n\n'), 1)
+        lines = header.split(b('\n'))
+        user = lines[1]
+        fields = lines[2].split(b(' '), 2)
+        extra = _decodeextra(fields[2]) if len(fields) > 2 else {}
+        # truncate the timezone like hgclient._parserev()
+        posixtime = float(fields[0].split(b('.'), 1)[0])
+        return hglib.client.revision(
+            strtobytes(rev), node, b(''),
+            extra.get(b('branch'), b('default')), user, desc,
+            datetime.datetime.fromtimestamp(posixtime))
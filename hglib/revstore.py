@@ -0,0 +1,261 @@
+"""Compact containers for long lists of revisions."""
+import array, binascii, datetime, re
+import hglib.client  # Circular dependency.
+from hglib import util
+from hglib.util import b
+
+class _interned(object):
+    """A column of values repeated a lot (branches, authors) kept as
+    indexes into a table of the distinct values"""
+    def __init__(self):
+        self.table = []
+        self._ids = {}
+        self.ids = array.array('I')
+
+    def append(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self.table)
+            self.table.append(value)
+        self.ids.append(i)
+
+    def __getitem__(self, i):
+        return self.table[self.ids[i]]
+
+class revisions(object):
+    """
+    A read-only sequence of the revisions in the output of the changeset
+    template (see templates.changeset), stored by column: revision numbers
+    and dates in arrays, nodes packed in a single buffer of 20-byte binary
+    hashes, branches and authors as indexes into tables of their distinct
+    values, descriptions in a single buffer and tags only for the
+    revisions that have some.
+
+    Indexing builds the same revision tuples as hgclient.log(), the
+    accessors read a single field without building one.
+
+    >>> revs = revisions([b('1'), b('1') * 40, b('tip'), b('default'),
+    ...                   b('bob'), b('two'), b('10.0-7200'),
+    ...                   b('0'), b('0') * 40, b(''), b('default'),
+    ...                   b('bob'), b('one'), b('5.0-7200')])
+    >>> len(revs), revs.rev(1), revs.author(0) == b('bob')
+    (2, 0, True)
+    >>> revs[0].node == b('1') * 40, revs[1].tags == b('')
+    (True, True)
+    >>> [r.desc for r in revs] == [b('two'), b('one')]
+    True
+    """
+    def __init__(self, fields=()):
+        self._revs = array.array('l')
+        self._dates = array.array('d')
+        self._nodes = bytearray()
+        self._tags = {}
+        self._branches = _interned()
+        self._authors = _interned()
+        self._descs = bytearray()
+        self._descends = array.array('L')
+        for rev in util.grouper(7, fields):
+            self.append(rev)
+
+    def append(self, rev):
+        """add a revision given as the 7 fields of the changeset template"""
+        i = len(self._revs)
+        self._revs.append(int(rev[0]))
+        self._nodes += binascii.unhexlify(rev[1])
+        if rev[2]:
+            self._tags[i] = rev[2]
+        self._branches.append(rev[3])
+        self._authors.append(rev[4])
+        self._descs += rev[5]
+        self._descends.append(len(self._descs))
+        # truncate the timezone like hgclient._parserev()
+        self._dates.append(float(rev[6].split(b('.'), 1)[0]))
+
+    def __len__(self):
+        return len(self._revs)
+
+    def _index(self, i):
+        if i < 0:
+            i += len(self._revs)
+        if not 0 <= i < len(self._revs):
+            raise IndexError('revision index out of range')
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self._index(i)
+        return hglib.client.revision(
+            util.strtobytes(self._revs[i]), self.node(i), self.tags(i),
+            self._branches[i], self._authors[i], self.desc(i), self.date(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def rev(self, i):
+        return self._revs[self._index(i)]
+
+    def binnode(self, i):
+        """the node of the i-th revision as a 20-byte binary hash"""
+        i = self._index(i)
+        return bytes(self._nodes[i * 20:i * 20 + 20])
+
+    def node(self, i):
+        return binascii.hexlify(self.binnode(i))
+
+    def tags(self, i):
+        return self._tags.get(self._index(i), b(''))
+
+    def branch(self, i):
+        return self._branches[self._index(i)]
+
+    def author(self, i):
+        return self._authors[self._index(i)]
+
+    def desc(self, i):
+        i = self._index(i)
+        start = self._descends[i - 1] if i else 0
+        return bytes(self._descs[start:self._descends[i]])
+
+    def date(self, i):
+        return datetime.datetime.fromtimestamp(self._dates[self._index(i)])
+
+    @property
+    def revs(self):
+        """the revision numbers, as an array"""
+        return self._revs
+
+    @property
+    def branches(self):
+        """the distinct branches"""
+        return list(self._branches.table)
+
+    @property
+    def authors(self):
+        """the distinct authors"""
+        return list(self._authors.table)
+
+class lazyrevision(object):
+    """
+    A revision of a lazyrevisions, read from the shared output buffer only
+    when its fields are accessed. It has the accessors of revision and can
+    be indexed and unpacked like one.
+    """
+    __slots__ = ('_buf', '_start', '_end', '_fields')
+
+    def __init__(self, buf, start, end):
+        self._buf = buf
+        self._start = start
+        self._end = end
+        self._fields = None
+
+    def _split(self):
+        if self._fields is None:
+            self._fields = self._buf[self._start:self._end].split(b('\0'))[:7]
+        return self._fields
+
+    @property
+    def rev(self):
+        if self._fields is not None:
+            return self._fields[0]
+        return self._buf[self._start:self._buf.index(b('\0'), self._start)]
+
+    @property
+    def node(self):
+        if self._fields is not None:
+            return self._fields[1]
+        start = self._buf.index(b('\0'), self._start) + 1
+        return self._buf[start:start + 40]
+
+    @property
+    def tags(self):
+        return self._split()[2]
+
+    @property
+    def branch(self):
+        return self._split()[3]
+
+    @property
+    def author(self):
+        return self._split()[4]
+
+    @property
+    def desc(self):
+        return self._split()[5]
+
+    @property
+    def date(self):
+        # truncate the timezone like hgclient._parserev()
+        posixtime = float(self._split()[6].split(b('.'), 1)[0])
+        return datetime.datetime.fromtimestamp(posixtime)
+
+    def _tuple(self):
+        return tuple(self._split()[:6]) + (self.date,)
+
+    def __len__(self):
+        return 7
+
+    def __getitem__(self, i):
+        return self._tuple()[i]
+
+    def __iter__(self):
+        return iter(self._tuple())
+
+    def __eq__(self, other):
+        return self._tuple() == tuple(other)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self._tuple())
+
+    def __repr__(self):
+        return 'lazyrevision%r' % (self._tuple(),)
+
+# the 7 NUL-terminated fields of a revision of the changeset template
+_record = re.compile(b('(?:[^\0]*\0){7}'))
+
+class lazyrevisions(object):
+    """
+    A read-only sequence of the revisions in buf, the output of the
+    changeset template (see templates.changeset). Only the offsets of the
+    revisions are kept, their fields are split and decoded by lazyrevision
+    when they're accessed.
+
+    >>> revs = lazyrevisions(b('\\0').join([
+    ...     b('1'), b('1') * 40, b('tip'), b('default'), b('bob'), b('two'),
+    ...     b('10.0-7200'), b('0'), b('0') * 40, b(''), b('default'),
+    ...     b('bob'), b('one'), b('5.0-7200'), b('')]))
+    >>> len(revs), revs[1].rev == b('0'), revs[-2].node == b('1') * 40
+    (2, True, True)
+    >>> [r.desc for r in revs] == [b('two'), b('one')]
+    True
+    >>> rev, node, tags, branch, author, desc, date = revs[0]
+    >>> tags == b('tip')
+    True
+    """
+    def __init__(self, buf):
+        self._buf = buf
+        # one match per revision found by the regex engine, which doesn't
+        # copy the fields out of buf
+        self._starts = array.array('L', [0])
+        self._starts.extend(m.end() for m in _record.finditer(buf))
+        self._len = len(self._starts) - 1
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('revision index out of range')
+        return lazyrevision(self._buf, self._starts[i], self._starts[i + 1] - 1)
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
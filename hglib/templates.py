@@ -2,3 +2,16 @@ from hglib.util import b
 
 changeset = b('{rev}\\0{node}\\0{tags}\\0{branch}\\0{author}'
               '\\0{desc}\\0{date}\\0')
+
+# changeset followed by what changectx would otherwise query separately:
+# parents, phase, bookmarks, added, modified and removed files (one per
+# line) and the hidden and obsolete flags
+changesetext = changeset + b('{p1node}\\0{p2node}\\0{phase}\\0{bookmarks}'
+                             "\\0{join(file_adds, '\\n')}"
+                             "\\0{join(file_mods, '\\n')}"
+                             "\\0{join(file_dels, '\\n')}"
+                             "\\0{ifcontains(rev, revset('hidden()'), 'hidden')}"
+                             '\\0{obsolete}\\0')
+
+# the phase and the hidden flag of a revision, see hgclient.phases()
+phase = b("{rev}\\0{phase}\\0{ifcontains(rev, revset('hidden()'), 'hidden')}\\0")
@@ -1,5 +1,11 @@
-import os, subprocess, sys
+import os, subprocess, sys, socket, tempfile, hashlib, threading, errno
+import signal, time
+from collections import OrderedDict
 from hglib import error
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 try:
     from io import BytesIO
 except ImportError:
@@ -70,6 +76,50 @@ def skiplines(s, prefix):
 
     return b('')
 
+def splitchunks(chunks, sep):
+    """
+    Yield the sep terminated records found in the iterable of byte chunks,
+    followed by the unterminated rest if it's not empty
+
+    >>> list(splitchunks([b('a\\0b'), b('c\\0\\0d')], b('\\0'))) == [
+    ...     b('a'), b('bc'), b(''), b('d')]
+    True
+    >>> list(splitchunks([b('a\\0')], b('\\0'))) == [b('a')]
+    True
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        # the rest has no separator: only look at the new data, and at the
+        # end of the rest for a separator the chunk completes
+        scan = max(len(buf) - len(sep) + 1, 0)
+        buf += chunk
+        start = 0
+        end = buf.find(sep, scan)
+        while end != -1:
+            yield bytes(buf[start:end])
+            start = end + len(sep)
+            end = buf.find(sep, start)
+        if start:
+            del buf[:start]
+    if buf:
+        yield bytes(buf)
+
+def iterlines(chunks):
+    """
+    Yield the lines of the iterable of byte chunks the same way
+    bytes.splitlines() would split them joined together
+
+    >>> list(iterlines([b('a\\r'), b('\\nb\\n\\nc\\rd')])) == [
+    ...     b('a'), b('b'), b(''), b('c'), b('d')]
+    True
+    """
+    for record in splitchunks(chunks, b('\n')):
+        lines = record.splitlines()
+        if not lines:
+            yield record
+        for line in lines:
+            yield line
+
 def _cmdval(val):
     if isinstance(val, bytes):
         return val
@@ -199,6 +249,55 @@ class propertycache(object):
         setattr(obj, self.name, result)
         return result
 
+class lrucache(object):
+    """
+    A thread safe mapping that keeps the maxsize most recently used entries
+    and counts hits, misses and evictions.
+
+    >>> c = lrucache(2)
+    >>> c.put('a', 1); c.put('b', 2); c.get('a')
+    1
+    >>> c.put('c', 3); c.get('b') is None
+    True
+    >>> c.hits, c.misses, c.evictions, len(c)
+    (1, 1, 1, 2)
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 close_fds = os.name == 'posix'
 
 startupinfo = None
@@ -206,7 +305,7 @@ if os.name == 'nt':
     startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-def popen(args, env=None):
+def popen(args, env=None, cwd=None):
     environ = None
     if env:
         environ = dict(os.environ)
@@ -214,4 +313,130 @@ def popen(args, env=None):
 
     return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE, close_fds=close_fds,
-                            startupinfo=startupinfo, env=environ)
+                            startupinfo=startupinfo, env=environ, cwd=cwd)
+
+def socketpath(path):
+    """Return the unix socket path of the forking command server for the
+    repository at path, in a private directory of the current user"""
+    d = os.path.join(tempfile.gettempdir(), 'hglib-%d' % os.getuid())
+    try:
+        os.mkdir(d, 0o700)
+    except OSError:
+        if not os.path.isdir(d):
+            raise
+    path = os.path.realpath(path)
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(d, name + '.sock')
+
+class filelock(object):
+    """An exclusive lock on the file at path, between processes as well as
+    threads, held in a with block. Does nothing where fcntl isn't
+    available."""
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+def _cmdline(pid):
+    """the arguments of process pid, [] if there's no such process, None
+    where /proc doesn't tell"""
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return f.read().split(b('\0'))
+    except (IOError, OSError):
+        return [] if os.path.isdir('/proc/self') else None
+
+def _isserver(pid, socketpath):
+    """True if process pid is the command server listening on socketpath,
+    False if it's another one, which has the pid of a server that crashed
+    or was running before a reboot. Where /proc isn't available, the
+    server has to answer on socketpath."""
+    args = _cmdline(pid)
+    if args is not None:
+        return (b('serve') in args and b('--cmdserver') in args and
+                socketpath.encode(sys.getfilesystemencoding()) in args)
+    try:
+        conn = unixconnection(socketpath)
+    except (IOError, OSError):
+        return False
+    try:
+        # the hello message on the output channel
+        return conn.stdout.read(5)[:1] == b('o')
+    except (IOError, OSError):
+        return False
+    finally:
+        conn.communicate()
+
+def serverpid(socketpath):
+    """the pid of the forking command server listening on socketpath, as
+    written to its pid file, None if unknown or if, where /proc tells,
+    that process isn't the server"""
+    try:
+        with open(socketpath + '.pid', 'rb') as f:
+            pid = int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+    args = _cmdline(pid)
+    if args is not None and not _isserver(pid, socketpath):
+        return None
+    return pid
+
+def stopserver(socketpath, timeout=2):
+    """
+    Stop the forking command server listening on socketpath. The servers
+    it forked for open connections run until they're closed. Return True
+    if a server was stopped. Files left behind by a server that is gone
+    are removed without signalling the process that now has its pid.
+    """
+    with filelock(socketpath + '.lock'):
+        pid = serverpid(socketpath)
+        stopped = False
+        if pid is not None and _isserver(pid, socketpath):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                stopped = True
+            except OSError:
+                pass
+            # it removes its socket on the way out
+            end = time.time() + timeout
+            while stopped and os.path.exists(socketpath) and time.time() < end:
+                time.sleep(0.02)
+        for path in (socketpath, socketpath + '.pid'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return stopped
+
+class unixconnection(object):
+    """A connection to a command server listening on a unix socket with the
+    same stdin/stdout/communicate() interface as the Popen object of a pipe
+    server. Closing it ends the connection, the server keeps running."""
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except Exception:
+            self._sock.close()
+            raise
+        self.stdin = self._sock.makefile('wb')
+        self.stdout = self._sock.makefile('rb')
+        self.returncode = None
+
+    def communicate(self):
+        self.stdin.close()
+        self.stdout.close()
+        self._sock.close()
+        self.returncode = 0
+        return b(''), b('')
@@ -0,0 +1,302 @@
+"""Track the paths touched in a working directory with Linux inotify, so
+hg status can be limited to them instead of walking the whole tree."""
+import os, sys, struct, select, threading, time, errno
+import ctypes, ctypes.util
+from hglib import repostate
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCHMASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+             IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+             IN_DONTFOLLOW)
+
+eventstruct = struct.Struct('iIII')
+
+# the order of the codes in hg status' output
+STATUSORDER = b'MAR!?IC'
+
+_libc = None
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+def available():
+    """True when inotify can be used on this system"""
+    try:
+        return hasattr(_inotify(), 'inotify_init1')
+    except OSError:
+        return False
+
+def _within(path, paths):
+    """True if path is one of paths or inside one of them"""
+    while True:
+        if path in paths:
+            return True
+        i = path.rfind(b'/')
+        if i < 0:
+            return False
+        path = path[:i]
+
+class dirtywatcher(object):
+    """
+    Watch all the directories of the working directory at root (but not
+    .hg or nested repositories) and record the paths touched since the
+    last status.
+
+    status() runs a full status the first time and whenever the watcher
+    can't vouch for the paths it recorded: the event queue overflowed, the
+    dirstate or .hgignore changed, too many paths were touched, or the
+    last full status is older than reconcile seconds. Otherwise only the
+    touched paths are passed to hg and their status is merged into the
+    previous one.
+
+    On reconciliation the merged status is compared with the full one,
+    stats counts the entries they disagreed on in 'mismatches' along with
+    the number and total seconds of partial and full statuses.
+    """
+    def __init__(self, root, reconcile=600, maxpaths=1000):
+        self.root = root
+        self.reconcile = reconcile
+        self.maxpaths = maxpaths
+        self._stats = {'partial': 0, 'partialtime': 0.0,
+                       'full': 0, 'fulltime': 0.0,
+                       'reconciled': 0, 'mismatches': 0}
+
+        self._libc = _inotify()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._rpipe, self._wpipe = os.pipe()
+        self._root = os.fsencode(root)
+        self._lock = threading.Lock()
+        self._statuslock = threading.Lock()
+        # wd -> directory relative to root, b'' being root itself
+        self._dirs = {}
+        self._touched = set()
+        # set when the touched paths can't be trusted
+        self._overflow = True
+        self._ready = False
+        self._closed = False
+        # the last status as a path -> code dict, and when and on which
+        # dirstate it was taken
+        self._status = None
+        self._statustime = 0
+        self._dirstatekey = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _addwatch(self, rel):
+        path = os.path.join(self._root, rel) if rel else self._root
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCHMASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                # gone before it could be watched, it's touched anyway
+                return
+            # most likely out of watches (fs.inotify.max_user_watches)
+            raise OSError(e, os.strerror(e))
+        with self._lock:
+            self._dirs[wd] = rel
+
+    def _watchtree(self, rel):
+        """watch rel and all the directories below it"""
+        top = os.path.join(self._root, rel) if rel else self._root
+        for dirpath, dirnames, filenames in os.walk(top):
+            if self._closed:
+                return
+            if dirpath != self._root and b'.hg' in dirnames:
+                # a nested repository, hg status doesn't look into it
+                dirnames[:] = []
+                continue
+            dirnames[:] = [d for d in dirnames if d != b'.hg']
+            self._addwatch(os.path.relpath(dirpath, self._root)
+                           if dirpath != self._root else b'')
+
+    def _run(self):
+        try:
+            self._watchtree(b'')
+        except OSError:
+            self._closewatch()
+            return
+        with self._lock:
+            self._ready = True
+            # a status taken during the walk missed the edits made in the
+            # directories that weren't watched yet
+            self._overflow = True
+        while not self._closed:
+            r = select.select([self._fd, self._rpipe], [], [])[0]
+            if self._closed or self._rpipe in r:
+                break
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            try:
+                self._process(data)
+            except OSError:
+                break
+        self._closewatch()
+
+    def _process(self, data):
+        newdirs = []
+        pos = 0
+        while pos + eventstruct.size <= len(data):
+            wd, mask, cookie, length = eventstruct.unpack_from(data, pos)
+            pos += eventstruct.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            with self._lock:
+                if mask & IN_Q_OVERFLOW:
+                    self._overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                rel = self._dirs.get(wd)
+                if rel is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # the parent directory reports it under its new name
+                    if mask & IN_MOVE_SELF:
+                        self._libc.inotify_rm_watch(self._fd, wd)
+                        del self._dirs[wd]
+                    if rel:
+                        self._touched.add(rel)
+                    else:
+                        self._overflow = True
+                    continue
+                path = rel + b'/' + name if rel else name
+                if not rel and name == b'.hg':
+                    continue
+                if path == b'.hgignore':
+                    self._overflow = True
+                self._touched.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                newdirs.append(path)
+        for path in newdirs:
+            self._watchtree(path)
+
+    def _closewatch(self):
+        with self._lock:
+            self._ready = False
+            self._dirs.clear()
+            fd, self._fd = self._fd, -1
+        if fd >= 0:
+            os.close(fd)
+
+    @property
+    def watching(self):
+        """True while all the directories are watched"""
+        return self._ready
+
+    @property
+    def stats(self):
+        """a copy of the counters, taken at once"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    def _take(self):
+        """Return the paths to pass to hg status, None for a full status"""
+        with self._lock:
+            key = repostate.dirstatekey(self.root)
+            full = (not self._ready or self._overflow or
+                    self._status is None or key != self._dirstatekey or
+                    len(self._touched) > self.maxpaths)
+            reconcile = (not full and
+                         time.time() - self._statustime > self.reconcile)
+            touched, self._touched = self._touched, set()
+            if full or reconcile:
+                self._overflow = False
+                self._dirstatekey = key
+            return (None if full else touched), reconcile
+
+    def _merge(self, touched, entries):
+        status = dict((path, code) for path, code in self._status.items()
+                      if not _within(path, touched))
+        status.update((path, code) for code, path in entries)
+        return status
+
+    def _result(self, status):
+        return sorted(((code, path) for path, code in status.items()),
+                      key=lambda e: (STATUSORDER.find(e[0]), e[1]))
+
+    def status(self, run):
+        """
+        Return the working directory status as a list of (code, path)
+        tuples like hgclient.status().
+
+        run(files) has to return the status entries of files (absolute
+        paths), printing the paths relative to the root, and of the whole
+        working directory when files is None.
+        """
+        with self._statuslock:
+            try:
+                return self._runstatus(run)
+            except Exception:
+                # the paths taken for this status are lost
+                with self._lock:
+                    self._overflow = True
+                raise
+
+    def _runstatus(self, run):
+        touched, reconcile = self._take()
+        if touched is not None:
+            # on reconciliation too, to tell how the merged status did
+            start = time.time()
+            files = [os.path.join(self._root, p) for p in sorted(touched)]
+            status = self._merge(touched, run(files) if files else [])
+            self._count(partial=1, partialtime=time.time() - start)
+            if not reconcile:
+                self._status = status
+                return self._result(status)
+        start = time.time()
+        entries = run(None)
+        self._count(full=1, fulltime=time.time() - start)
+        full = dict((path, code) for code, path in entries)
+        if touched is not None:
+            self._count(reconciled=1,
+                        mismatches=len(set(full.items()) ^
+                                       set(status.items())))
+        self._status = full
+        self._statustime = start
+        return self._result(full)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            os.write(self._wpipe, b'x')
+        except OSError:
+            pass
+        self._thread.join(1)
+        os.close(self._rpipe)
+        os.close(self._wpipe)
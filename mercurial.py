@@ -1,7 +1,12 @@
 import sys
 import os
-from threading import Thread, Lock
+import copy
+import socket
+import time
+import types
+from threading import Thread, Lock, Event
 from functools import partial
+from collections import deque, OrderedDict
 
 import sublime
 import sublime_plugin
@@ -9,21 +14,216 @@ import sublime_plugin
 sys.path.append(os.path.dirname(__file__))
 
 import hglib
+from hglib import repostate, revlog
 
 
-servers = {}
+# least recently used first
+servers = OrderedDict()
+servers_lock = Lock()
+shared_server = None
+shared_server_lock = Lock()
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_READ = 1
+PRIORITY_BACKGROUND = 2
+
+# functions not listed here are interactive
+PRIORITIES = {
+    'status': PRIORITY_READ,
+    'diff': PRIORITY_READ,
+    'incoming': PRIORITY_READ,
+    'outgoing': PRIORITY_READ,
+    'branches': PRIORITY_READ,
+    'summary': PRIORITY_BACKGROUND,
+}
+
+
+def settings():
+    return sublime.load_settings('MercurialCommands.sublime-settings')
 
 
 class HgServer(object):
 
     def __init__(self, folder):
         super(HgServer, self).__init__()
-        self.server = hglib.open(folder)
+        self.folder = folder
+        self._server = None
+        self._server_lock = Lock()
         self._summary = None
         self.commit_history = []
+        self._jobs = [deque() for _ in range(PRIORITY_BACKGROUND + 1)]
+        self._jobs_lock = Lock()
+        self._worker = None
+        self._running = 0
+        # key -> job for the read-only jobs queued or running
+        self._inflight = {}
+        self.created = self.last_used = time.time()
+        # seconds from creation until the first summary was available
+        self.first_status = None
+        self._refresh_lock = Lock()
+        self._refresh_pending = False
+        self._refresh_running = False
+        # (probe, summary) of the last summary run with hg, see summary_from_probe()
+        self._baseline = None
+        # the working directory status shared by the commands, see working_copy()
+        self._wc = None
+        self._wc_lock = Lock()
+        self._wc_touched = set()
+        self._wc_generation = 0
+        self.wc_version = 0
+        self.probe_stats = {'probed': 0, 'summaries': 0}
+        # the servers' encoding, read when they're first opened
+        self._encoding = None
+        # the socket of the unix mode daemon, see _open()
+        self._socketpath = None
+        # read in process for the branch of the working directory parent
+        self._changelog = revlog.changelog(folder)
+
+    def _open(self):
+        mode = settings().get('cmdserver')
+        cachesize = settings().get('result_cache_size', 64)
+        watch = settings().get('status_watch', False) and settings().get('status_reconcile_interval', 600)
+        if mode == 'shared':
+            # clients of the shared server run one command at a time anyway
+            factory = partial(_get_shared_server().forrepo, self.folder)
+            return hglib.pool.clientpool(size=1, factory=factory, cachesize=cachesize, watch=watch)
+        socketpath = None
+        if mode == 'unix' and hasattr(socket, 'AF_UNIX'):
+            socketpath = hglib.util.socketpath(self.folder)
+        self._socketpath = socketpath
+        return hglib.openpool(self.folder, size=settings().get('pool_size', 2), socketpath=socketpath,
+                              cachesize=cachesize, watch=watch)
+
+    @property
+    def server(self):
+        """The pool of command servers, reopened if it was closed."""
+        with self._server_lock:
+            if self._server is None:
+                self._server = self._open()
+                if self._encoding is None:
+                    self._encoding = self._server.encoding.decode()
+            return self._server
+
+    @property
+    def encoding(self):
+        """The servers' encoding, opening them the first time."""
+        if self._encoding is None:
+            self.server
+        return self._encoding
+
+    @property
+    def is_open(self):
+        return self._server is not None
 
     def close(self):
-        self.server.close()
+        with self._server_lock:
+            if self._server is not None:
+                self._server.close()
+                self._server = None
+
+    def close_if_idle(self, stop_daemon=False):
+        """Close the command servers unless a job is queued or running, and
+        stop the unix mode daemon too if stop_daemon, which otherwise
+        outlives them."""
+        with self._jobs_lock:
+            if self.busy or not self.is_open:
+                return False
+            self.close()
+            if stop_daemon and self._socketpath:
+                hglib.util.stopserver(self._socketpath)
+            return True
+
+    @property
+    def busy(self):
+        return bool(self._running or self.pending)
+
+    @property
+    def pids(self):
+        """Process ids of the command servers, the unix mode daemon included."""
+        server = self._server
+        pids = set(server.pids) if server is not None else set()
+        if self._socketpath:
+            pid = hglib.util.serverpid(self._socketpath)
+            if pid is not None:
+                pids.add(pid)
+        return pids
+
+    @property
+    def pending(self):
+        return sum(map(len, self._jobs))
+
+    def schedule(self, job):
+        """Queue the job for this repository.
+
+        Jobs for one repository run one after another, higher priority first
+        and in the order they were scheduled within the same priority. Each
+        repository has its own worker so different repositories don't wait
+        for each other. Read-only jobs run in parallel on the server pool
+        while the worker goes on with the next job.
+
+        A read-only job without output callback that is identical to a job
+        already queued or running isn't run, it gets the result of the
+        other job instead.
+        """
+        with self._jobs_lock:
+            self.last_used = time.time()
+            if job.func in hglib.pool.readonly and not job.on_output:
+                job.key = (job.func, repr(job.args), repr(sorted(job.kwargs.items())))
+                leader = self._inflight.get(job.key)
+                if leader is not None:
+                    leader.followers.append(job)
+                    return
+                self._inflight[job.key] = job
+            self._jobs[job.priority].append(job)
+            if self._worker is None:
+                self._worker = Thread(target=self._work)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            with self._jobs_lock:
+                queue = next(filter(bool, self._jobs), None)
+                if queue is None:
+                    self._worker = None
+                    return
+                job = queue.popleft()
+                pending = self.pending
+                self._running += 1
+            readonly = job.func in hglib.pool.readonly
+            try:
+                pool = self.server
+                client = pool.acquire(readonly)
+            except Exception as e:
+                self._job_finished()
+                job._done(err=str(e))
+                continue
+            if readonly:
+                t = Thread(target=self._run, args=(job, pool, client, pending))
+                t.daemon = True
+                t.start()
+            else:
+                self._run(job, pool, client, pending)
+
+    def _run(self, job, pool, client, pending):
+        try:
+            job.run(client, pending)
+        finally:
+            pool.release(client)
+            self._job_finished()
+
+    def land(self, job):
+        """Return the jobs waiting for the result of the finished job."""
+        with self._jobs_lock:
+            if job.key is None or self._inflight.get(job.key) is not job:
+                return []
+            del self._inflight[job.key]
+            return list(job.followers)
+
+    def _job_finished(self):
+        with self._jobs_lock:
+            self._running -= 1
+            self.last_used = time.time()
 
     @property
     def summary(self):
@@ -32,6 +232,213 @@ class HgServer(object):
     @summary.setter
     def summary(self, value):
         self._summary = value
+        if value is not None and self.first_status is None:
+            self.first_status = time.time() - self.created
+
+    def request_refresh(self):
+        """Refresh the summary and the status of all the repository's views.
+
+        Requests arriving within status_refresh_delay milliseconds are
+        coalesced into a single summary, and there is at most one summary
+        waiting while another one runs."""
+        with self._refresh_lock:
+            if self._refresh_pending:
+                return
+            self._refresh_pending = True
+        sublime.set_timeout_async(self._start_refresh, settings().get('status_refresh_delay', 500))
+
+    def _start_refresh(self):
+        with self._refresh_lock:
+            if not self._refresh_pending or self._refresh_running:
+                # already started by another timeout, or started again when
+                # the running one is done
+                return
+            self._refresh_pending = False
+            self._refresh_running = True
+        probe = self.probe()
+        summary = self.summary_from_probe(probe)
+        if summary is None:
+            HgCommandJob(self, 'summary', partial(self._refresh_done, probe), None, None, None, None).start()
+            return
+        self.summary = summary
+        self._refresh_finished()
+
+    def _refresh_done(self, probe, output, err):
+        if output:
+            self.update_summary(output, probe)
+        else:
+            self.summary = None
+        self._refresh_finished()
+
+    def _refresh_finished(self):
+        update_status_views(self)
+        with self._refresh_lock:
+            self._refresh_running = False
+            pending = self._refresh_pending
+        if pending:
+            sublime.set_timeout_async(self._start_refresh, settings().get('status_refresh_delay', 500))
+
+    def update_summary(self, output, probe=None):
+        """Set the summary from the output of hglib's summary. probe is the
+        repository's probe taken before the summary was started."""
+        self.summary = {
+            'branch': str(output[b'branch'], self.encoding),
+            'commit': output[b'commit'],
+            'update': output[b'update']
+        }
+        self._baseline = (probe, self.summary) if probe else None
+        self.probe_stats['summaries'] += 1
+
+    def probe(self):
+        try:
+            return repostate.probe(self.folder)
+        except Exception:
+            return None
+
+    def summary_from_probe(self, probe):
+        """Return the summary as far as it can be told from probe and the last
+        summary run with hg, or None if hg has to run the summary.
+
+        The branch is always known. The updates are as many as before when
+        neither the working directory parent and branch nor the changelog,
+        phases and obsolescence markers changed: hg counts the changesets
+        between the parent and each head of the branch, so the parent
+        being the tip doesn't mean there are none when the branch has
+        other heads. The working directory is dirty during a merge, and
+        still dirty when it was and the dirstate wasn't touched since.
+        With no change it's clean unless its branch isn't the parent's
+        branch, which hg reports as a new branch."""
+        if probe is None or self._baseline is None:
+            return None
+        last, summary = self._baseline
+        p1, p2 = probe['parents']
+        if (p1 == last['parents'][0] and probe['branch'] == last['branch'] and
+                probe['tip'] == last['tip'] and probe['store'] == last['store']):
+            update = summary['update']
+        else:
+            return None
+        entries = self.fresh_working_copy()
+        if p2 != repostate.nullid:
+            commit = False
+        elif entries:
+            commit = False
+        elif entries is not None:
+            branch = self.branch_of(p1)
+            if branch is None:
+                return None
+            commit = branch == probe['branch']
+        elif (not summary['commit'] and probe['parents'] == last['parents'] and
+                probe['dirstate'] == last['dirstate']):
+            commit = False
+        else:
+            return None
+        self.probe_stats['probed'] += 1
+        return {
+            # stored in UTF-8, and the servers may not be open yet
+            'branch': str(probe['branch'], 'utf-8', 'replace'),
+            'commit': commit,
+            'update': update
+        }
+
+    def branch_of(self, node):
+        """Return the branch of the changeset node read from the changelog,
+        None if it can't be read without hg."""
+        if node == repostate.nullid:
+            return b'default'
+        try:
+            self._changelog.refresh()
+            rev = self._changelog.rev(node)
+            return None if rev is None else self._changelog[rev].branch
+        except Exception:
+            return None
+
+    def fresh_working_copy(self):
+        """The status entries of the working copy snapshot if it's up to
+        date, without running hg."""
+        with self._wc_lock:
+            if self._valid_working_copy() and not self._wc_touched:
+                return list(self._wc['entries'])
+        return None
+
+    def _valid_working_copy(self):
+        wc = self._wc
+        if wc is None:
+            return False
+        if (wc['dirstate'] != repostate.dirstatekey(self.folder) or
+                time.time() - wc['time'] > settings().get('working_copy_max_age', 10)):
+            self._wc = None
+            return False
+        return True
+
+    def working_copy(self, on_done):
+        """Call on_done(entries, err) on the main thread with the status of
+        the working directory, as returned by hglib's status.
+
+        The status is kept as a snapshot shared by the commands. It is reused
+        until hg changes the dirstate, a command invalidates it or it gets
+        older than working_copy_max_age seconds. Files saved since it was
+        taken are refreshed with a status limited to them."""
+        with self._wc_lock:
+            if self._valid_working_copy():
+                wc = self._wc
+                touched, self._wc_touched = self._wc_touched, set()
+            else:
+                wc = None
+                touched = set()
+                self._wc_touched.clear()
+            generation = self._wc_generation
+            dirstate = repostate.dirstatekey(self.folder)
+            taken = time.time()
+        if wc is not None and not touched:
+            main_thread(on_done, list(wc['entries']), None)
+            return
+        files = sorted(touched) if wc is not None else None
+        HgCommandJob(
+            self, 'status',
+            partial(self._working_copy_done, wc, files, generation, dirstate, taken, on_done),
+            None, None, None, None,
+            files=files
+        ).start()
+
+    def _working_copy_done(self, wc, files, generation, dirstate, taken, on_done, entries, err):
+        if entries is None:
+            with self._wc_lock:
+                if files and generation == self._wc_generation:
+                    self._wc_touched.update(files)
+            on_done(entries, err)
+            return
+        if files is not None:
+            paths = set(os.fsencode(os.path.relpath(f, self.folder).replace(os.sep, '/')) for f in files)
+            merged = dict((path, code) for code, path in wc['entries'] if path not in paths)
+            merged.update((path, code) for code, path in entries)
+            entries = sorted(((code, path) for path, code in merged.items()),
+                             key=lambda e: (hglib.watcher.STATUSORDER.find(e[0]), e[1]))
+            # the other files are as old as the snapshot
+            taken = wc['time']
+        with self._wc_lock:
+            if generation == self._wc_generation:
+                self.wc_version += 1
+                self._wc = {
+                    'version': self.wc_version,
+                    'entries': entries,
+                    'dirstate': dirstate,
+                    'time': taken,
+                }
+        on_done(list(entries), err)
+
+    def touch_working_copy(self, fn):
+        """Record that the file fn was saved since the snapshot was taken."""
+        # relative to the root, which is a real path, when it's merged
+        fn = os.path.realpath(fn)
+        with self._wc_lock:
+            if self._wc is not None:
+                self._wc_touched.add(fn)
+
+    def invalidate_working_copy(self):
+        with self._wc_lock:
+            self._wc = None
+            self._wc_touched.clear()
+            self._wc_generation += 1
 
     def add_commit_message(self, message):
         if message in self.commit_history:
@@ -42,41 +449,267 @@ class HgServer(object):
 
 
 def stop_all_servers():
-    global servers
-    for v in servers.values():
+    global servers, shared_server
+    with servers_lock:
+        srvs = list(servers.values())
+    for v in srvs:
         if v is not None:
             v.close()
+    with shared_server_lock:
+        if shared_server is not None:
+            shared_server.close()
+            shared_server = None
+
+
+def _get_shared_server():
+    global shared_server
+    with shared_server_lock:
+        if shared_server is None:
+            shared_server = hglib.openshared()
+        return shared_server
 
 
 def _get_server(folder):
     global servers
-    if folder not in servers:
-        servers[folder] = HgServer(folder)
-    return servers[folder]
-    if folder in servers:
-        return servers[folder]
+    with servers_lock:
+        srv = servers.get(folder)
+        if srv is not None:
+            servers.move_to_end(folder)
+            return srv
+    srv = HgServer(folder)
+    with servers_lock:
+        existing = servers.setdefault(folder, srv)
+    if existing is not srv:
+        srv.close()
+    return existing
+
+
+def process_rss(pid):
+    """Resident memory of the process in bytes, None where unknown."""
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def servers_rss(srvs):
+    """Return the resident memory in bytes of the command servers of each of
+    srvs, as a dict, and of all of them. Each process is counted once: one
+    used by several repositories (the shared server) counts in the total
+    but for none of them, closing one of them wouldn't free it. Sizes are
+    None where unknown."""
+    pids = dict((srv, srv.pids) for srv in srvs)
+    users = {}
+    for srv, ps in pids.items():
+        for pid in ps:
+            users[pid] = users.get(pid, 0) + 1
+    sizes = dict((pid, process_rss(pid)) for pid in users)
+
+    def total(ps):
+        if None in (sizes[pid] for pid in ps):
+            return None
+        return sum(sizes[pid] for pid in ps)
+
+    own = dict((srv, total([pid for pid in ps if users[pid] == 1]))
+               for srv, ps in pids.items())
+    return own, total(users)
+
+
+def evict_servers():
+    """Close the command servers of repositories idle for longer than
+    server_idle_timeout seconds, then the least recently used ones while
+    there are more than max_servers open or they use more than
+    max_servers_rss MB. They're reopened when needed again."""
+    s = settings()
+    timeout = s.get('server_idle_timeout', 600)
+    max_servers = s.get('max_servers', 10)
+    max_rss = s.get('max_servers_rss', 0) * 1024 * 1024
+    now = time.time()
+    with servers_lock:
+        srvs = [srv for srv in servers.values() if srv.is_open]
+    evicted = []
+    if timeout:
+        for srv in list(srvs):
+            idle = now - srv.last_used
+            if idle > timeout and srv.close_if_idle(stop_daemon=True):
+                srvs.remove(srv)
+                evicted.append((srv, 'idle for {:.0f}s'.format(idle)))
+    if max_servers:
+        for srv in list(srvs):
+            if len(srvs) <= max_servers:
+                break
+            if srv.close_if_idle(stop_daemon=True):
+                srvs.remove(srv)
+                evicted.append((srv, 'more than {} servers'.format(max_servers)))
+    if max_rss:
+        own, total = servers_rss(srvs)
+        total = total or 0
+        for srv in list(srvs):
+            if total <= max_rss:
+                break
+            if not own[srv]:
+                # nothing to free by closing it
+                continue
+            if srv.close_if_idle(stop_daemon=True):
+                srvs.remove(srv)
+                total -= own[srv]
+                evicted.append((srv, 'more than {} MB'.format(max_rss // 1024 // 1024)))
+    for srv, reason in evicted:
+        print('MercurialCommands: closed command servers of {} ({})'.format(srv.folder, reason))
+    if evicted:
+        print('MercurialCommands: {} repositories with open command servers, {}'.format(
+            len(srvs), format_size(servers_rss(srvs)[1])))
+
+
+def _evict_servers_periodically():
+    try:
+        evict_servers()
+    finally:
+        if plugin_is_loaded:
+            sublime.set_timeout_async(_evict_servers_periodically, 60000)
+
+
+def format_size(size):
+    if size is None:
+        return 'unknown'
+    return '{:.1f} MB'.format(size / 1024 / 1024)
 
 
 def is_hg_root(d):
     return os.path.exists(os.path.join(d, '.hg'))
 
 
-def hg_root(d):
+# directory -> (repository root or None, mtime of the directory)
+root_index = {}
+root_index_lock = Lock()
+root_index_stats = {'hits': 0, 'misses': 0}
+
+
+def _mtime(d):
+    try:
+        return os.stat(d).st_mtime
+    except OSError:
+        return None
+
+
+def _find_hg_root(d):
+    """Walk up from d to the nearest repository root, return it and the
+    directories visited on the way."""
+    visited = []
     while d:
+        visited.append(d)
         if is_hg_root(d):
-            return d
+            return d, visited
         p = os.path.realpath(os.path.join(d, os.path.pardir))
         if p == d:
-            return None
+            return None, visited
         d = p
-    return None
+    return None, visited
+
+
+def hg_root(d):
+    """Return the root of the innermost repository containing the directory
+    d (resolving symlinks), None if there is none.
+
+    Results are remembered per directory and reused while the directory's
+    mtime doesn't change (creating or removing a .hg in it changes it) and the
+    root is still a repository. Repositories created or removed between a
+    directory and its root need the index to be refreshed."""
+    if not d:
+        return None
+    mtime = _mtime(d)
+    with root_index_lock:
+        entry = root_index.get(d)
+    if entry is not None and entry[1] == mtime and (entry[0] is None or is_hg_root(entry[0])):
+        root_index_stats['hits'] += 1
+        return entry[0]
+    root_index_stats['misses'] += 1
+    root, visited = _find_hg_root(os.path.realpath(d))
+    entries = dict((v, (root, _mtime(v))) for v in visited)
+    entries[d] = (root, mtime)
+    with root_index_lock:
+        root_index.update(entries)
+    return root
+
+
+def refresh_root_index():
+    with root_index_lock:
+        root_index.clear()
+
+
+plugin_is_loaded = False
+
+
+def prewarm_servers():
+    """Start the command servers of the repositories open in all windows
+    and get their summaries, at most prewarm_parallelism at a time, so the
+    status bar is ready when a view is activated."""
+    parallelism = settings().get('prewarm_parallelism', 2)
+    if not parallelism:
+        return
+    folders = []
+    for w in sublime.windows():
+        for f in w.folders():
+            d = hg_root(f)
+            if d and d not in folders:
+                folders.append(d)
+    if not folders:
+        return
+    start = time.time()
+    lock = Lock()
+
+    def prewarm():
+        while True:
+            with lock:
+                if not folders:
+                    return
+                folder = folders.pop(0)
+            _prewarm_server(folder)
+
+    threads = [Thread(target=prewarm) for _ in range(min(parallelism, len(folders)))]
+    count = len(folders)
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print('MercurialCommands: prewarmed {} repositories in {:.2f}s'.format(count, time.time() - start))
+
+
+def _prewarm_server(folder):
+    try:
+        srv = _get_server(folder)
+    except Exception as e:
+        print('MercurialCommands: failed to start command server for {}: {}'.format(folder, e))
+        return
+    if srv.summary:
+        return
+    done = Event()
+    probe = srv.probe()
+
+    def on_done(output, err):
+        if output:
+            srv.update_summary(output, probe)
+            for w in sublime.windows():
+                v = w.active_view()
+                if v:
+                    v.run_command('hg_branch_status')
+        done.set()
+
+    HgCommandJob(srv, 'summary', on_done, None, None, None, None).start()
+    done.wait(60)
 
 
 def plugin_loaded():
-    pass
+    global plugin_is_loaded
+    plugin_is_loaded = True
+    Thread(target=prewarm_servers, daemon=True).start()
+    sublime.set_timeout_async(_evict_servers_periodically, 60000)
 
 
 def plugin_unloaded():
+    global plugin_is_loaded
+    plugin_is_loaded = False
     stop_all_servers()
 
 
@@ -84,12 +717,15 @@ def main_thread(callback, *args, **kwargs):
     sublime.set_timeout(partial(callback, *args, **kwargs), 0)
 
 
-class HgCommandThread(Thread):
-    command_lock = Lock()
-    prompt_lock = Lock()
+class HgCommandJob(object):
 
     def __init__(self, srv, func, on_done, on_output, on_prompt, on_command, on_ret, *args, **kwargs):
-        super(HgCommandThread, self).__init__()
+        super(HgCommandJob, self).__init__()
+        self.prompt_lock = Lock()
+        self.priority = PRIORITIES.get(func, PRIORITY_INTERACTIVE)
+        # set by HgServer.schedule() for jobs that others can wait for
+        self.key = None
+        self.followers = []
         self.srv = srv
         self.func = func
         self.on_done = on_done
@@ -119,51 +755,64 @@ class HgCommandThread(Thread):
     def _done(self, output=None, err=None):
         if self.on_done:
             main_thread(self.on_done, output, err)
+        if self.srv:
+            for job in self.srv.land(self):
+                if job.on_done:
+                    # a copy each, the output can be a list or a dict
+                    main_thread(job.on_done, copy.deepcopy(output), err)
 
     def _output(self, output):
         if self.on_output:
-            main_thread(self.on_output, output)
+            main_thread(self.on_output, bytes(output))
 
     def _error(self, output):
         self._output(output)
         self._cbret(2)
 
     def _cbret(self, ret):
-        if ret and self.on_ret:
-            main_thread(self.on_ret, ret)
+        for job in [self] + self.followers:
+            if ret and job.on_ret:
+                main_thread(job.on_ret, ret)
 
-    def run(self):
+    def start(self):
         if not self.srv:
             self._done()
             return
+        self.srv.schedule(self)
+
+    def run(self, client, pending=0):
         output = None
         err = None
-        self.command_lock.acquire()
+        if self.on_command:
+            main_thread(self.on_command, self.func, pending)
+        client.setcbout(self._output)
+        client.setcberr(self._error)
+        client.setcbret(self._cbret)
+        client.setcbprompt(lambda size, x: self._prompt(x) + b'\n')
         try:
-            if self.on_command:
-                main_thread(self.on_command, self.func)
-            srv = self.srv.server
-            srv.setcbout(self._output)
-            srv.setcberr(self._error)
-            srv.setcbret(self._cbret)
-            srv.setcbprompt(lambda size, x: self._prompt(x) + b'\n')
-            try:
-                output = getattr(srv, self.func)(*self.args, **self.kwargs)
-            except hglib.error.CommandError as ex:
-                encoding = srv.encoding.decode()
-                err = '\n'.join(filter(bool, [
-                    str(ex.out.rstrip(), encoding),
-                    str(ex.err.rstrip(), encoding)
-                ]))
-            except Exception as e:
-                err = str(e)
-        finally:
-            self.command_lock.release()
+            output = getattr(client, self.func)(*self.args, **self.kwargs)
+            if isinstance(output, types.GeneratorType):
+                # annotate, manifest... run their command when iterated,
+                # which has to happen before the client is released
+                output = list(output)
+        except hglib.error.CommandError as ex:
+            encoding = client.encoding.decode()
+            err = '\n'.join(filter(bool, [
+                str(ex.out.rstrip(), encoding),
+                str(ex.err.rstrip(), encoding)
+            ]))
+        except Exception as e:
+            err = str(e)
         self._done(output, err)
 
 
 class HgCommand(object):
 
+    @property
+    def encoding(self):
+        # read from the server when it's needed, which opens it
+        return self.srv.encoding
+
     def _cbout(self, data):
         o = str(data, self.encoding)
         self.panel(o)
@@ -198,23 +847,25 @@ class HgCommand(object):
             self.show_panel()
         self.on_done(output, err)
 
-    def _command(self, func):
+    def _command(self, func, pending=0):
         if self.log_output:
             self.panel('', clear=True)
         v = self.get_view()
         if v:
-            v.set_status('HgCommand', 'Hg: ' + func)
+            status = 'Hg: ' + func
+            if pending:
+                status += ' (+{} queued)'.format(pending)
+            v.set_status('HgCommand', status)
 
     def run_hg_function(self, func, on_done=None, log_output=True, on_ret=None, *args, **kwargs):
         self.srv = self.get_server()
         if not self.srv:
             self._done(None, None)
             return
-        self.encoding = self.srv.server.encoding.decode()
         self.log_output = log_output
         self.on_done = on_done or self._done
         self.return_code = 0
-        self.active_hg_command = HgCommandThread(
+        self.active_hg_command = HgCommandJob(
             self.srv,
             func,
             self._command_done,
@@ -267,8 +918,16 @@ class HgCommand(object):
         self.get_window().focus_view(v)
         return v
 
+    def working_copy_status(self, on_done):
+        self.srv = self.get_server()
+        if not self.srv:
+            on_done(None, None)
+            return
+        self.srv.working_copy(on_done)
+
     def reset_summary(self):
         self.srv.summary = None
+        self.srv.invalidate_working_copy()
         v = self.get_view()
         if v:
             v.run_command('hg_branch_status')
@@ -296,7 +955,7 @@ class HgTextCommand(HgCommand, sublime_plugin.TextCommand):
             return None
         fn = self.view.file_name()
         if fn:
-            d = hg_root(os.path.realpath(os.path.dirname(fn)))
+            d = hg_root(os.path.dirname(fn))
         else:
             v = self.get_window().extract_variables()
             d = v.get('folder', v.get('file_path'))
@@ -323,6 +982,27 @@ class HgWindowCommand(HgCommand, sublime_plugin.WindowCommand):
         return None
 
 
+def set_view_status(view, summary):
+    if not summary:
+        view.erase_status('HgState')
+        return
+    s = summary['branch']
+    if not summary['commit']:
+        s += ' ‼'
+    if summary['update']:
+        s += ' ^'
+    view.set_status('HgState', str(s))
+
+
+def update_status_views(srv):
+    """Show the server's summary in all the views of its repository."""
+    for w in sublime.windows():
+        for v in w.views():
+            fn = v.file_name()
+            if fn and hg_root(os.path.dirname(fn)) == srv.folder:
+                set_view_status(v, srv.summary)
+
+
 class HgBranchStatusCommand(HgTextCommand):
 
     def _done(self, output, err):
@@ -332,30 +1012,25 @@ class HgBranchStatusCommand(HgTextCommand):
                 self.show_panel()
             self.view.erase_status('HgState')
             return
-        self.srv.summary = {
-            'branch': str(output[b'branch'], self.encoding),
-            'commit': output[b'commit'],
-            'update': output[b'update']
-        }
-        self._set_status(self.srv)
-
-    def _set_status(self, srv):
-        s = srv.summary['branch']
-        if not srv.summary['commit']:
-            s += ' ‼'
-        if srv.summary['update']:
-            s += ' ^'
-        self.view.set_status('HgState', str(s))
+        self.srv.update_summary(output, self.probe)
+        set_view_status(self.view, self.srv.summary)
 
     def run(self, edit, force=False):
         srv = self.get_server()
         if not srv:
             self.view.erase_status('HgState')
             return
-        if force or not srv.summary:
+        if force and self.view.file_name():
+            srv.touch_working_copy(self.view.file_name())
+        if not srv.summary:
+            self.probe = srv.probe()
+            srv.summary = srv.summary_from_probe(self.probe)
+        if not srv.summary:
             self.run_hg_function('summary', log_output=False)
         else:
-            self._set_status(srv)
+            set_view_status(self.view, srv.summary)
+            if force:
+                srv.request_refresh()
 
 
 class HgBranchStatusListener(sublime_plugin.EventListener):
@@ -526,7 +1201,7 @@ class HgStatusCommand(HgWindowCommand):
             self.panel(err if err else 'No changes')
 
     def run(self):
-        self.run_hg_function('status', log_output=False)
+        self.working_copy_status(self._done)
 
 
 class HgDiffCommand(HgWindowCommand):
@@ -638,7 +1313,7 @@ class HgCommitCommand(HgWindowCommand):
     def run(self, message=None, close_branch=False):
         self.close_branch = close_branch
         self.message = message
-        self.run_hg_function('status', log_output=False, on_done=self._on_status_done)
+        self.working_copy_status(self._on_status_done)
 
     def on_message_done(self, message):
         message = message.split('\n# ----------')[0].strip()
@@ -676,3 +1351,49 @@ class HgRebaseCommand(HgWindowCommand):
 
     def run(self, continue_rebase=None, abort_rebase=None):
         self.run_hg_function('rebase', continue_rebase=continue_rebase, abort_rebase=abort_rebase)
+
+
+class HgServersCommand(HgWindowCommand):
+
+    def run(self):
+        now = time.time()
+        with servers_lock:
+            srvs = list(servers.values())
+        output = []
+        own, total = servers_rss(srvs)
+        for srv in reversed(srvs):
+            rss = own[srv]
+            cache = srv.server.cache if srv.is_open else None
+            output.append('{}\t{}\t{}\tidle {:.0f}s\t{} queued\tfirst status {}\tcache {}\tstatus {} probed, {} summaries'.format(
+                srv.folder,
+                'open' if srv.is_open else 'closed',
+                'shared' if rss == 0 and srv.pids else format_size(rss),
+                now - srv.last_used,
+                srv.pending,
+                'n/a' if srv.first_status is None else '{:.2f}s'.format(srv.first_status),
+                'off' if cache is None else '{} hits, {} misses'.format(cache.hits, cache.misses),
+                srv.probe_stats['probed'],
+                srv.probe_stats['summaries']
+            ))
+            watcher = srv.server.watcher if srv.is_open else None
+            if watcher is not None:
+                st = watcher.stats
+                output.append('\tstatus watch: {}, {} partial (avg {:.0f}ms), {} full (avg {:.0f}ms), '
+                              '{} mismatches in {} reconciliations'.format(
+                                  'on' if watcher.watching else 'off',
+                                  st['partial'], 1000 * st['partialtime'] / (st['partial'] or 1),
+                                  st['full'], 1000 * st['fulltime'] / (st['full'] or 1),
+                                  st['mismatches'], st['reconciled']))
+        output.append('')
+        output.append('{} repositories, {} open, {}'.format(
+            len(srvs), len([srv for srv in srvs if srv.is_open]), format_size(total)))
+        hits, misses = root_index_stats['hits'], root_index_stats['misses']
+        output.append('Repository index: {} directories, {} hits, {} misses ({:.0f}% hit rate)'.format(
+            len(root_index), hits, misses, 100.0 * hits / ((hits + misses) or 1)))
+        self.scratch('\n'.join(output), title='Hg: Command servers')
+
+
+class HgRefreshRepositoryIndexCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        refresh_root_index()